@@ -0,0 +1,256 @@
+# Answers a file (or stdin) of questions, one per line, streaming the answers
+# out as JSON lines in the same order. Questions are answered in batches that
+# move through a pipeline of stages:
+#   parse (nlp.pipe) -> resolve entities (and their predicates) -> match
+#   templates -> run queries
+# Each stage runs in its own thread and hands batches to the next one through
+# a bounded queue, so i.e. the next batch is being parsed while the entities
+# of this one are looked up. Within a stage, the work is done for the whole
+# batch at once (nlp.pipe, a single query for the entities and one for their
+# predicates, a single similarity matrix product), except for the candidate
+# queries, which are run concurrently
+
+
+import sys
+import json
+import time
+import queue
+import logging
+import threading
+import config
+import metrics
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, Callable, Dict, Iterable, Iterator, List, Union
+from labels import in_chunks
+from utils import (get_nlp, convert_doc_to_template, get_uris, flatten_uris, get_entity_predicates,
+                   get_allowed_predicates, get_similar_templates_batch, get_candidates, find_answer,
+                   describe_match)
+
+log = logging.getLogger('logger')
+
+# marks the end of the batches passed between stages
+DONE = object()
+
+
+class StageError:
+    """
+    Wraps an error raised by a stage, so it can be passed down the pipeline
+    and raised by the consumer
+    """
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def run_stage(stage: Callable, inputs: queue.Queue, outputs: queue.Queue) -> None:
+    while True:
+        batch = inputs.get()
+        if batch is DONE or isinstance(batch, StageError):
+            outputs.put(batch)
+            return
+        try:
+            outputs.put(stage(batch))
+        except BaseException as error:
+            outputs.put(StageError(error))
+            return
+
+
+def run_pipeline(batches: Iterable, stages: List[Callable], depth: int = 2) -> Iterator:
+    """
+    Passes each batch through the stages in order, yielding the results in
+    the order of the batches. Each stage runs in its own thread, with at most
+    `depth` batches waiting between two stages
+    """
+    queues = [queue.Queue(maxsize=depth) for _ in range(len(stages) + 1)]
+    threads = [threading.Thread(target=run_stage, args=(stage, queues[i], queues[i + 1]), daemon=True)
+               for i, stage in enumerate(stages)]
+    for thread in threads:
+        thread.start()
+
+    def feed():
+        try:
+            for batch in batches:
+                queues[0].put(batch)
+        except BaseException as error:
+            queues[0].put(StageError(error))
+            return
+        queues[0].put(DONE)
+
+    threading.Thread(target=feed, daemon=True).start()
+
+    while True:
+        result = queues[-1].get()
+        if result is DONE:
+            return
+        if isinstance(result, StageError):
+            raise result.error
+        yield result
+
+
+class BatchAnswerer:
+    """
+    The stages used to answer a batch of questions. Each item of a batch is a
+    dict in the same format returned by utils.answer_question
+    """
+
+    def __init__(
+        self,
+        templates: List,
+        vectors: Union[np.ndarray, None] = None,
+        index=None,
+        workers: int = None
+    ):
+        self.templates = templates
+        self.vectors = vectors
+        self.index = index
+        workers = config.BATCH_WORKERS if workers == None else workers
+        # candidate queries are run by find_answer on the query executor, so
+        # waiting on them needs a pool of its own
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def parse(self, questions: List[str]) -> List[Dict]:
+        start = time.perf_counter()
+        texts = questions
+        if config.STRIP_POSSESSIVE_APOSTROPHES:
+            texts = [question.replace("'s ", ' ') for question in questions]
+
+        batch = []
+        for question, doc in zip(questions, get_nlp().pipe(texts)):
+            question_template, entities = convert_doc_to_template(doc)
+            batch.append({
+                'question': question,
+                'template': question_template,
+                'entities': entities,
+                'uris': {},
+                'match': None,
+                'answers': None,
+                'timings': {}
+            })
+
+        elapsed = (time.perf_counter() - start) / max(len(batch), 1)
+        for item in batch:
+            item['timings']['parse'] = elapsed
+        return batch
+
+    def resolve_entities(self, batch: List[Dict]) -> List[Dict]:
+        # the entities (and then their predicates) of the whole batch are
+        # looked up together, in as few queries as the endpoint allows
+        start = time.perf_counter()
+        uris = get_uris([entity for item in batch for entity in item['entities']])
+        for item in batch:
+            item['uris'] = {entity.text: uris[entity.text]
+                            for entity in item['entities'] if entity.text in uris}
+        elapsed = (time.perf_counter() - start) / max(len(batch), 1)
+        for item in batch:
+            item['timings']['entities'] = elapsed
+
+        if not config.PRUNE_PREDICATES:
+            return batch
+
+        start = time.perf_counter()
+        items = [item for item in batch if len(item['uris']) > 0]
+        predicates = get_entity_predicates(
+            [uri for item in items for uri in flatten_uris(item['uris'])])
+        elapsed = (time.perf_counter() - start) / max(len(items), 1)
+        for item in items:
+            item['predicates'] = {uri: predicates[uri]
+                                  for uri in flatten_uris(item['uris'])}
+            item['timings']['predicates'] = elapsed
+        return batch
+
+    def match_templates(self, batch: List[Dict]) -> List[Dict]:
+        start = time.perf_counter()
+        items = [item for item in batch if len(item['uris']) > 0]
+        similar = get_similar_templates_batch(
+            [item['template'] for item in items], self.templates, self.vectors,
+            config.MAX_TEMPLATE_SEARCHES, self.index,
+            [get_allowed_predicates(item.get('predicates', {})) for item in items])
+
+        elapsed = (time.perf_counter() - start) / max(len(items), 1)
+        for item, templates in zip(items, similar):
+            item['similar'] = templates
+            item['timings']['templates'] = elapsed
+        return batch
+
+    def run_queries(self, batch: List[Dict]) -> List[Dict]:
+        def answer(item):
+            start = time.perf_counter()
+            candidates = get_candidates(
+                item.pop('similar'), item['uris'], item.get('predicates'))
+            found = find_answer(candidates)
+            item['timings']['queries'] = time.perf_counter() - start
+            if found == None:
+                item['answers'] = []
+            else:
+                rank, item['answers'] = found
+                item['match'] = describe_match(*candidates[rank])
+
+        futures = [self.executor.submit(answer, item)
+                   for item in batch if len(item.get('similar', [])) > 0]
+        for future in futures:
+            future.result()
+
+        for item in batch:
+            item.pop('similar', None)
+            item.pop('predicates', None)
+            item['entities'] = [entity.text for entity in item['entities']]
+            item['timings']['total'] = sum(item['timings'].values())
+            metrics.observe_timings(item['timings'])
+        return batch
+
+    def answer_all(self, questions: Iterable[str], batch_size: int = None) -> Iterator[Dict]:
+        """
+        Yields the answers of the questions, in order
+        """
+        batch_size = config.BATCH_SIZE if batch_size == None else batch_size
+        stages = [self.parse, self.resolve_entities,
+                  self.match_templates, self.run_queries]
+        for batch in run_pipeline(in_chunks(questions, batch_size), stages):
+            yield from batch
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=True)
+
+
+def read_questions(file: IO[str]) -> Iterator[str]:
+    for line in file:
+        question = line.strip()
+        if question != '':
+            yield question
+
+
+def run_batch(
+    path: str,
+    templates: List,
+    vectors: Union[np.ndarray, None] = None,
+    index=None,
+    batch_size: int = None,
+    output: IO[str] = None
+) -> None:
+    """
+    Answers the questions in the file ('-' for stdin), writing a JSON line
+    per question to the output (stdout by default)
+    """
+    output = sys.stdout if output == None else output
+    answerer = BatchAnswerer(templates, vectors, index)
+    start = time.perf_counter()
+    total = 0
+    answered = 0
+
+    file = sys.stdin if path == '-' else open(path, encoding='utf8')
+    try:
+        for item in answerer.answer_all(read_questions(file), batch_size):
+            output.write(json.dumps(item, ensure_ascii=False) + '\n')
+            output.flush()
+            total += 1
+            if item['answers'] != None and len(item['answers']) > 0:
+                answered += 1
+    finally:
+        if file is not sys.stdin:
+            file.close()
+        answerer.shutdown()
+
+    elapsed = time.perf_counter() - start
+    log.info(
+        f'Answered {answered} of {total} questions in {elapsed:.1f}s ({total / elapsed if elapsed > 0 else 0:.1f} questions/s)')
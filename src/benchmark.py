@@ -1,28 +1,219 @@
 import logging
 import json
 import os
-from utils import get_answer
+import sys
+import time
+import statistics
+import subprocess
+import config
+import metrics
+import numpy as np
+from datetime import datetime
+from typing import Dict, List, Union
+from urllib.parse import unquote
+from utils import answer_question, flatten_uris, get_nlp
 
 log = logging.getLogger('logger')
 
 
-def run_benchmark(templates):
+# the SimpleDBpediaQA datasets have the gold subject and predicates of each
+# question, the sample questions are just the questions
+datasets = {
+    'test': './datasets/SimpleDBpediaQA-test.json',
+    'valid': './datasets/SimpleDBpediaQA-valid.json',
+    'sample': './datasets/sample-questions.json',
+}
+
+stages = ['parse', 'entities', 'predicates', 'skeletons', 'templates', 'ranking', 'queries', 'total']
+percentiles = [50, 95, 99]
+
+
+def load_dataset(name: str, limit: Union[int, None] = None) -> List[Dict]:
+    """
+    Returns the questions of the dataset as SimpleDBpediaQA style dicts
+    """
+    with open(datasets[name], encoding='utf8') as file:
+        data = json.load(file)
+
+    if isinstance(data, dict):
+        questions = data['Questions']
+    else:
+        questions = [{'ID': str(i + 1), 'Query': question}
+                     for i, question in enumerate(data)]
+
+    return questions[:limit]
+
+
+def normalize_uri(uri: Union[None, str]) -> Union[None, str]:
+    return None if uri == None else unquote(uri)
+
+
+def score_question(question: Dict, details: Dict) -> Dict:
+    """
+    Compares how the question was answered against its gold subject and
+    predicates (if the dataset has them)
+    """
+    match = details['match']
+    uris = [normalize_uri(uri) for uri in flatten_uris(details['uris'])]
+    record = {
+        'id': question['ID'],
+        'question': question['Query'],
+        'entities': details['entities'],
+        'uris': uris,
+        'match': match,
+        'answers': details['answers'],
+        'answered': details['answers'] != None and len(details['answers']) > 0,
+        'timings': details['timings'],
+    }
+
+    if 'Subject' not in question:
+        return record
+
+    subject = normalize_uri(question['Subject'])
+    predicates = [normalize_uri(predicate['Predicate'])
+                  for predicate in question['PredicateList'] if predicate['Direction'] == 'forward']
+    predicate = None if match == None else normalize_uri(match['predicate'])
+
+    record['gold'] = {'subject': subject, 'predicates': predicates}
+    record['predicate'] = predicate
+    # entity linking is scored on whether the gold subject was found at all,
+    # and whether it was the one used by the answer
+    record['entity_found'] = subject in uris
+    record['entity_correct'] = match != None and normalize_uri(
+        match['uri']) == subject
+    record['predicate_correct'] = predicate in predicates
+    record['correct'] = record['entity_correct'] and record['predicate_correct']
+    return record
+
+
+def summarize(records: List[Dict]) -> Dict:
+    total = len(records)
+    summary = {
+        'questions': total,
+        'answered': sum(record['answered'] for record in records) / total if total > 0 else 0,
+    }
+
+    scored = [record for record in records if 'gold' in record]
+    if len(scored) > 0:
+        for key in ['entity_found', 'entity_correct', 'predicate_correct', 'correct']:
+            summary[key] = sum(record[key] for record in scored) / len(scored)
+
+    summary['latency'] = {}
+    for stage in stages:
+        durations = [record['timings'][stage]
+                     for record in records if stage in record['timings']]
+        if len(durations) == 0:
+            continue
+        summary['latency'][stage] = {
+            f'p{p}': float(value) for p, value in zip(percentiles, np.percentile(durations, percentiles))}
+        summary['latency'][stage]['mean'] = statistics.mean(durations)
+
+    return summary
+
+
+def run_benchmark(templates, vectors=None, index=None, dataset: str = None, limit: Union[int, None] = None) -> Dict:
+    """
+    Compare performance of algorithm against a dataset, scoring the entity
+    linking and predicates against the gold labels (if the dataset has them)
+    and the latency of each stage. The results are saved to results/ as JSON
+    """
+    dataset = config.BENCHMARK_DATASET if dataset == None else dataset
+    limit = config.BENCHMARK_LIMIT if limit == None else limit
+    started = datetime.now()
+    questions = load_dataset(dataset, limit)
+    total = len(questions)
+    records = []
+
+    for i, question in enumerate(questions):
+        log.info(f'Testing {i + 1} of {total}: {question["Query"]}')
+        details = answer_question(
+            question['Query'], templates, vectors, index)
+        record = score_question(question, details)
+        records.append(record)
+        if record['answered']:
+            log.info(details['answers'])
+        else:
+            log.info('INCORRECT\n')
+
+    results = {
+        'dataset': dataset,
+        'started': started.isoformat(),
+        'config': {
+            'metric': config.SIMILARITY_METRIC,
+            'threshold': config.THRESHOLD,
+            'search': config.SEARCH_MODE,
+            'word_embeddings': config.WORD_EMBEDDINGS_SIZE,
+            'max_template_searches': config.MAX_TEMPLATE_SEARCHES,
+            'merge_queries': config.MERGE_QUERIES,
+            'prune_predicates': config.PRUNE_PREDICATES,
+            'endpoint': config.ENDPOINT,
+            'replay': config.REPLAY,
+            'replay_latency': config.REPLAY_LATENCY,
+        },
+        'summary': summarize(records),
+        'questions': records,
+        'metrics': metrics.registry.to_dict(),
+    }
+
+    summary = results['summary']
+    log.info(f'Answered: {summary["answered"]:.1%} of {total}')
+    if 'correct' in summary:
+        log.info(
+            f'Entity found: {summary["entity_found"]:.1%}, entity correct: {summary["entity_correct"]:.1%}, '
+            f'predicate correct: {summary["predicate_correct"]:.1%}, correct: {summary["correct"]:.1%}')
+    for stage, latency in summary['latency'].items():
+        log.info(f'{stage}: ' + ', '.join(
+            f'{name} {value:.3f}s' for name, value in latency.items()))
+
+    filename = f'results/{started.strftime("%Y:%m:%d-%H:%M:%S")}-{dataset}.json'
+    os.makedirs('results', exist_ok=True)
+    with open(filename, 'w', encoding='utf8') as file:
+        json.dump(results, file, ensure_ascii=False, indent=2)
+    log.info(f'Saved results to "{filename}"')
+
+    return results
+
+
+def time_command(command, runs: int, env=None) -> float:
+    """
+    Returns the median wall time of running the command
+    """
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, env=env, check=True)
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def run_startup_benchmark(runs: int = 5):
     """
-    Compare performance of algorithm against a sample dataset
+    Times how long the cli takes to start, and how long loading the spaCy
+    model takes now that it is deferred until it is first used. As a baseline,
+    the same import is timed with the model and the optional modules loaded
+    eagerly, the way they were at import time before
     """
+    source = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=source)
+    cli = os.path.join(source, 'rdfqa.py')
+    eager = 'import utils; utils.get_nlp(); from spacy import displacy; import tabulate'
 
-    answered = 0
+    timings = {
+        'rdfqa.py -h': time_command([sys.executable, cli, '-h'], runs),
+        'rdfqa.py -h (eager baseline)': time_command([sys.executable, '-c', eager + (
+            f'; import sys, runpy; sys.argv = [{cli!r}, "-h"]; runpy.run_path({cli!r}, run_name="__main__")')], runs, env),
+        'import utils': time_command([sys.executable, '-c', 'import utils'], runs, env),
+        'import utils (eager baseline)': time_command([sys.executable, '-c', eager], runs, env),
+    }
+    start = time.perf_counter()
+    get_nlp()
+    timings['first use of the model'] = time.perf_counter() - start
 
-    with open(f'./datasets/sample-questions.json') as file:
-        training_data = json.load(file)
-        total = len(training_data)
-        for index, question in enumerate(training_data):
-            log.info(f'Testing {index +1} of {total}: {question}')
-            answer = get_answer(question, templates)
-            if answer != None and len(answer) > 1:
-                log.info(answer)
-                answered += 1
-            else:
-                log.info('INCORRECT\n')
+    for name, duration in timings.items():
+        log.info(f'{name}: {duration:.3f}s')
+    for name in ['rdfqa.py -h', 'import utils']:
+        log.info(
+            f'Deferred loading saves {timings[f"{name} (eager baseline)"] - timings[name]:.3f}s on {name}')
 
-        log.info(f'Answered: {answered}\nTotal: {total}')
+    return timings
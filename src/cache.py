@@ -0,0 +1,187 @@
+# Persistent caches shared between runs (--ask, --question, --benchmark), for
+# entity URI lookups, entity predicates and SPARQL query results (bypassed
+# with --no-cache).
+# Values are stored as JSON in SQLite, so several processes can safely use
+# the same cache file at once. Entries can expire after a TTL, and the least
+# recently used entries are evicted once a cache grows past its max size
+
+
+import re
+import json
+import time
+import hashlib
+import sqlite3
+import logging
+import threading
+import config
+import metrics
+from typing import Any, Dict, Union
+
+log = logging.getLogger('logger')
+
+# once a cache grows past its max size, it is evicted down to this fraction of
+# it, so the eviction scan runs once per many writes instead of on every one
+EVICTION_RATIO = 0.9
+
+cache_requests_total = metrics.counter(
+    'rdfqa_cache_requests_total', 'Cache lookups, by cache and whether they hit')
+
+
+class DiskCache:
+    def __init__(
+        self,
+        filename: str,
+        max_entries: Union[int, None] = None,
+        ttl: Union[float, None] = None
+    ):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            f'{filename}.sqlite', timeout=30, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('pragma journal_mode=wal')
+            self.connection.execute("""create table if not exists cache (
+                key text primary key,
+                value text,
+                created real,
+                accessed real
+            )""")
+            self.connection.execute(
+                'create index if not exists cache_accessed on cache (accessed)')
+            # an upper bound on the number of entries (replacing a key counts as
+            # an insert), so the table is only counted once it might be too big
+            self.size = self.connection.execute(
+                'select count(*) from cache').fetchone()[0]
+
+    def __getitem__(self, key: str) -> Any:
+        """
+        Returns the cached value, raising a KeyError if it is missing or expired
+        """
+        now = time.time()
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                'select value, created from cache where key = ?', (key,)).fetchone()
+            if row != None and self.ttl != None and now - row[1] > self.ttl:
+                self.connection.execute(
+                    'delete from cache where key = ?', (key,))
+                row = None
+
+            if row == None:
+                self.misses += 1
+                cache_requests_total.inc(
+                    labels={'cache': self.filename, 'result': 'miss'})
+                raise KeyError(key)
+
+            self.hits += 1
+            cache_requests_total.inc(
+                labels={'cache': self.filename, 'result': 'hit'})
+            self.connection.execute(
+                'update cache set accessed = ? where key = ?', (now, key))
+
+        return json.loads(row[0])
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                'insert or replace into cache values (?, ?, ?, ?)', (key, json.dumps(value), now, now))
+            self.size += 1
+            if self.max_entries != None and self.size > self.max_entries:
+                self.evict()
+
+    def evict(self) -> None:
+        """
+        Evicts the least recently used entries if the cache is past its max
+        size (other processes may have evicted some already)
+        """
+        self.size = self.connection.execute(
+            'select count(*) from cache').fetchone()[0]
+        if self.size <= self.max_entries:
+            return
+
+        target = int(self.max_entries * EVICTION_RATIO)
+        self.connection.execute("""delete from cache where key in (
+            select key from cache order by accessed limit ?
+        )""", (self.size - target,))
+        self.size = target
+
+    def get_stats(self) -> Dict[str, int]:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total > 0 else 0
+        }
+
+    def clear(self) -> None:
+        with self.lock, self.connection:
+            self.connection.execute('delete from cache')
+            self.size = 0
+
+
+# string literals are kept as is, so only whitespace in the query itself is
+# collapsed when normalizing
+literal_regex = re.compile(r'("(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\')')
+whitespace_regex = re.compile(r'\s+')
+
+
+def normalize_query(query_string: str) -> str:
+    parts = literal_regex.split(query_string)
+    for i in range(0, len(parts), 2):
+        parts[i] = whitespace_regex.sub(' ', parts[i])
+    return ''.join(parts).strip()
+
+
+def get_query_key(query_string: str, endpoint: str) -> str:
+    normalized = normalize_query(query_string)
+    return hashlib.sha256(f'{endpoint}\n{normalized}'.encode('utf8')).hexdigest()
+
+
+caches: Dict[str, DiskCache] = {}
+caches_lock = threading.Lock()
+
+
+def get_cache(filename: str, max_entries: Union[int, None] = None, ttl: Union[float, None] = None) -> DiskCache:
+    """
+    Returns the cache stored in the file, opening it on first use
+    """
+    with caches_lock:
+        if filename not in caches:
+            caches[filename] = DiskCache(filename, max_entries, ttl)
+        return caches[filename]
+
+
+def get_uri_cache() -> DiskCache:
+    """
+    Maps an entity label to its URIs (with redirects already followed), or
+    None when the label has no match
+    """
+    ttl = None if config.URI_CACHE_TTL_DAYS == None else config.URI_CACHE_TTL_DAYS * 24 * 60 * 60
+    return get_cache(config.URI_CACHE_FILENAME, config.URI_CACHE_MAX_ENTRIES, ttl)
+
+
+def get_query_cache() -> DiskCache:
+    """
+    Maps a hash of a normalized query and its endpoint to the query's result
+    """
+    ttl = None if config.QUERY_CACHE_TTL_DAYS == None else config.QUERY_CACHE_TTL_DAYS * 24 * 60 * 60
+    return get_cache(config.QUERY_CACHE_FILENAME, config.QUERY_CACHE_MAX_ENTRIES, ttl)
+
+
+def get_predicate_cache() -> DiskCache:
+    """
+    Maps an entity URI to the distinct predicates it is the subject of
+    """
+    ttl = None if config.PREDICATE_CACHE_TTL_DAYS == None else config.PREDICATE_CACHE_TTL_DAYS * 24 * 60 * 60
+    return get_cache(config.PREDICATE_CACHE_FILENAME, config.PREDICATE_CACHE_MAX_ENTRIES, ttl)
+
+
+def log_cache_stats() -> None:
+    for filename, cache in caches.items():
+        stats = cache.get_stats()
+        log.info(
+            f'Cache "{filename}": {stats["hits"]} hits, {stats["misses"]} misses ({stats["hit_rate"]:.0%} hit rate)')
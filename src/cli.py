@@ -32,6 +32,82 @@ def init_parser() -> argparse.ArgumentParser:
         action="store_true",
         default=config.UPDATE
     )
+    parser.add_argument(
+        '-i',
+        '--incremental',
+        help='updates the cache of properties, only counting references of new properties or ones older than --max-age',
+        action='store_true',
+        default=False
+    )
+    parser.add_argument(
+        '--max-age',
+        help='number of days before the reference count of a property is considered stale',
+        action='store',
+        type=float,
+        default=config.PROPERTY_MAX_AGE_DAYS
+    )
+    parser.add_argument(
+        '-e',
+        '--endpoint',
+        help='the SPARQL endpoint to query (i.e. a local mirror or stand-in server)',
+        action='store',
+        default=config.ENDPOINT
+    )
+    parser.add_argument(
+        '--timeout',
+        help='seconds to wait for the endpoint to answer a query',
+        action='store',
+        type=float,
+        default=config.SPARQL_TIMEOUT
+    )
+    parser.add_argument(
+        '--workers',
+        help='number of concurrent queries used when updating the properties',
+        action='store',
+        type=int,
+        default=config.PROPERTY_WORKERS
+    )
+    parser.add_argument(
+        '--count-batch-size',
+        help='number of properties whose references are counted in a single query (1 to count them one at a time)',
+        action='store',
+        type=int,
+        default=config.REFERENCE_COUNT_BATCH_SIZE
+    )
+    parser.add_argument(
+        '--rate',
+        help='maximum number of requests per second sent to the endpoint (0 for no limit)',
+        action='store',
+        type=float,
+        default=config.REQUESTS_PER_SECOND
+    )
+    parser.add_argument(
+        '--record',
+        help='records every query sent to the endpoint and its response to a file, for --replay',
+        action='store'
+    )
+    parser.add_argument(
+        '--replay',
+        help='answers queries from a file made with --record instead of the endpoint (i.e. for offline benchmarks)',
+        action='store'
+    )
+    parser.add_argument(
+        '--replay-latency',
+        help='seconds each replayed query waits, to simulate the endpoint',
+        action='store',
+        type=float,
+        default=config.REPLAY_LATENCY
+    )
+    parser.add_argument(
+        '--labels-dump',
+        help='builds the local label index from a DBpedia labels N-Triples dump (.gz and .bz2 are supported)',
+        action='store'
+    )
+    parser.add_argument(
+        '--redirects-dump',
+        help='builds the local redirect index from a DBpedia redirects N-Triples dump (.gz and .bz2 are supported)',
+        action='store'
+    )
     parser.add_argument(
         "-t",
         "--templates",
@@ -52,6 +128,69 @@ def init_parser() -> argparse.ArgumentParser:
         action="store_true",
         default=config.BENCHMARK
     )
+    parser.add_argument(
+        '--dataset',
+        help='dataset the benchmark runs against (test and valid are SimpleDBpediaQA, scored against their gold subjects and predicates)',
+        choices=['test', 'valid', 'sample'],
+        action='store',
+        default=config.BENCHMARK_DATASET
+    )
+    parser.add_argument(
+        '--limit',
+        help='only benchmark the first N questions of the dataset',
+        action='store',
+        type=int,
+        default=config.BENCHMARK_LIMIT
+    )
+    parser.add_argument(
+        '--startup',
+        help='benchmarks the startup time of the cli and the spaCy model, against loading them eagerly',
+        action='store_true',
+        default=False
+    )
+    parser.add_argument(
+        '--batch',
+        help='answers the questions in a file (one per line, - for stdin), writing the answers to stdout as JSON lines',
+        action='store'
+    )
+    parser.add_argument(
+        '--batch-size',
+        help='number of questions that move through each stage of batch mode together',
+        action='store',
+        type=int,
+        default=config.BATCH_SIZE
+    )
+    parser.add_argument(
+        '--serve',
+        help='runs a server answering questions through a JSON API (POST /answer {"question": ...})',
+        action='store_true',
+        default=False
+    )
+    parser.add_argument(
+        '--host',
+        help='address the server listens on',
+        action='store',
+        default=config.SERVER_HOST
+    )
+    parser.add_argument(
+        '--port',
+        help='port the server listens on',
+        action='store',
+        type=int,
+        default=config.SERVER_PORT
+    )
+    parser.add_argument(
+        '--socket',
+        help='serve on a Unix socket at this path instead of a TCP port',
+        action='store'
+    )
+    parser.add_argument(
+        '--server-workers',
+        help='number of questions the server answers at once',
+        action='store',
+        type=int,
+        default=config.SERVER_WORKERS
+    )
     parser.add_argument(
         '-m',
         '--metric',
@@ -68,6 +207,47 @@ def init_parser() -> argparse.ArgumentParser:
         type=float,
         default=config.THRESHOLD
     )
+    parser.add_argument(
+        '--search',
+        help='exact scores every template, approximate only scores the templates found by the LSH index, hierarchical ranks the question skeletons and then the properties of the best ones',
+        choices=['exact', 'approximate', 'hierarchical'],
+        action='store',
+        default=config.SEARCH_MODE
+    )
+    parser.add_argument(
+        '--probes',
+        help='multi-probe radius of the LSH index for the nlp metric, also searching the buckets up to this many bit flips away (higher is better recall but slower)',
+        action='store',
+        type=int,
+        default=config.LSH_PROBES
+    )
+    parser.add_argument(
+        '--no-cache',
+        help='bypass the SPARQL result and entity URI caches',
+        action='store_false',
+        dest='cache',
+        default=config.CACHE
+    )
+    parser.add_argument(
+        '--no-prune',
+        help="don't limit the templates to the properties the entities actually have",
+        action='store_false',
+        dest='prune',
+        default=config.PRUNE_PREDICATES
+    )
+    parser.add_argument(
+        '--metrics',
+        help='saves the metrics (stage timings, cache hits, SPARQL requests) to a file on exit, in the Prometheus text format if it ends in .prom, otherwise as JSON',
+        action='store',
+        default=config.METRICS
+    )
+    parser.add_argument(
+        '--profile',
+        help='saves a profile of answering each question to the profiles directory',
+        choices=['cprofile', 'pyinstrument'],
+        action='store',
+        default=config.PROFILE
+    )
     parser.add_argument(
         '-w',
         '--word',
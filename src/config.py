@@ -1,17 +1,69 @@
+BATCH_SIZE = 64
+BATCH_WORKERS = 8
 BENCHMARK = False
+BENCHMARK_DATASET = 'sample'
+BENCHMARK_LIMIT = None
+CACHE = True
+CHECKPOINT_INTERVAL = 30
 DEBUG = False
 ENDPOINT = "http://dbpedia.org/sparql"
 FIGURES = False
+HIERARCHICAL_SKELETONS = 5
+INGEST_CHUNK_SIZE = 100000
+LABEL_BATCH_SIZE = 1000
+LABEL_INDEX_FILENAME = 'labels'
+LABEL_PROCESSES = 1
 LOG = False
+LSH_BITS = 12
+LSH_PROBES = 1
+LSH_TABLES = 16
 MAX_PROPERTY_LABEL_LENGTH = 12
+MAX_RETRIES = 3
 MAX_TEMPLATE_SEARCHES = 15
+MERGE_QUERIES = True
+METRICS = None
 MIN_PROPERTY_REFERENCE_COUNT = 200
+MINHASH_BANDS = 32
+MINHASH_ROWS = 4
+PAGE_SIZE = 10000  # typical max for Virtuoso servers
+PREDICATE_CACHE_FILENAME = 'predicates'
+PREDICATE_CACHE_MAX_ENTRIES = 100000
+PREDICATE_CACHE_TTL_DAYS = 7
+PROFILE = None
+PROFILE_DIRECTORY = 'profiles'
+PROGRESS_INTERVAL = 100
 PROMPT_AS_DEFAULT = False
+PROPERTIES_CHECKPOINT_FILENAME = 'properties.checkpoint'
 PROPERTIES_FILENAME = 'properties'
+PROPERTY_MAX_AGE_DAYS = 30
+PROPERTY_WORKERS = 8
+PRUNE_PREDICATES = True
+QUERY_CACHE_FILENAME = 'queries'
+QUERY_CACHE_MAX_ENTRIES = 50000
+QUERY_CACHE_TTL_DAYS = 7
+QUERY_WORKERS = 8
+RECORD = None
+REFERENCE_COUNT_BATCH_SIZE = 200
+REPLAY = None
+REPLAY_LATENCY = 0
+REQUESTS_PER_SECOND = 20
+RETRY_BACKOFF = 1.0
+SEARCH_MODE = 'exact'
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 8000
+SERVER_WORKERS = 4
+SHINGLE_SIZE = 3
 SIMILARITY_METRIC = 'nlp'
+SPARQL_CONNECT_TIMEOUT = 10
+SPARQL_MAX_CONNECTIONS = 16
+SPARQL_TIMEOUT = 120
 STRIP_POSSESSIVE_APOSTROPHES = True
 TEMPLATES_FILENAME = 'templates'
 THRESHOLD = 0.9
 TOP_KTH = 350
 UPDATE = False
+URI_CACHE_FILENAME = 'uris'
+URI_CACHE_MAX_ENTRIES = 100000
+URI_CACHE_TTL_DAYS = 30
+URI_LOOKUP_BATCH_SIZE = 100
 WORD_EMBEDDINGS_SIZE = 'lg'
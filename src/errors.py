@@ -2,5 +2,13 @@ class SPARQLQueryError(Exception):
     pass
 
 
+class SPARQLQueryRejected(SPARQLQueryError):
+    """
+    The query can never succeed as is (i.e. a 400 for bad syntax, or a query
+    missing from a replayed recording), so it isn't worth retrying
+    """
+    pass
+
+
 class SPARQLQueryTooLarge(Exception):
     pass
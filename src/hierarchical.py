@@ -0,0 +1,227 @@
+# Matches a question in two stages instead of scoring every expanded template.
+# Almost every template is one of the question_templates skeletons with a
+# property label substituted in, so:
+#   1. the skeletons are ranked against the question, with the words in the
+#      {property} slot of each skeleton left out (the 'residual' words)
+#   2. for the best skeletons, only the properties of their allowed types are
+#      ranked against the residual words
+# The few resulting templates are then scored against the whole question with
+# the similarity metric, so their similarities (and the threshold) mean the
+# same as when every template is scanned. Matching no longer depends on the
+# number of templates, so the property set can be much larger than TOP_KTH
+# allows when scanning
+
+
+import logging
+import config
+import numpy as np
+import levenshtein
+from typing import Dict, List, Set, Tuple, Union
+from templates import question_templates, common_statements
+from utils import get_nlp, get_simple_predicate, prefix_map
+
+log = logging.getLogger('logger')
+
+PROPERTY_SLOT = '{property}'
+
+
+def get_words(text: str) -> List[str]:
+    """
+    Splits text into words, leaving out punctuation (i.e. a trailing '?')
+    """
+    return [word for word in text.split() if any(char.isalnum() or char in '{}' for char in word)]
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+
+class Skeleton:
+    def __init__(self, template: str, property_types: Union[None, List[str]], common_types: Union[None, List[str]]):
+        self.template = template
+        self.property_types = property_types or []
+        self.common_types = common_types or []
+        words = template.format(subject='{e}', property=PROPERTY_SLOT).split()
+        if PROPERTY_SLOT in words:
+            slot = words.index(PROPERTY_SLOT)
+            self.before, self.after = words[:slot], words[slot + 1:]
+        else:
+            self.before, self.after = words, None
+        self.text = ' '.join(self.before + (self.after or []))
+
+    def has_property(self) -> bool:
+        return self.after != None
+
+    def split_question(self, words: List[str]) -> Union[None, Tuple[str, str]]:
+        """
+        Returns the question without the words in the skeleton's property slot,
+        and those words, or None if there is no room for a property
+        """
+        if not self.has_property():
+            return ' '.join(words), ''
+        end = len(words) - len(self.after)
+        if end <= len(self.before):
+            return None
+        return ' '.join(words[:len(self.before)] + words[end:]), ' '.join(words[len(self.before):end])
+
+    def expand(self, label: Union[None, str] = None) -> str:
+        if label == None:
+            return self.template.format(subject='{e}')
+        return self.template.format(subject='{e}', property=label)
+
+
+class HierarchicalMatcher:
+    def __init__(self, properties: Dict[str, List[Tuple[str, str]]], metric: str = None):
+        self.metric = config.SIMILARITY_METRIC if metric == None else metric
+        self.skeletons = [Skeleton(*template)
+                          for template in question_templates]
+        # property type -> [(uri, label)], and the matching index of labels
+        self.properties = {property_type: list(properties[property_type])
+                           for property_type in properties if len(properties[property_type]) > 0}
+        self.label_indexes = {}
+
+        if self.metric == 'nlp':
+            self.skeleton_vectors = self.embed(
+                [skeleton.text for skeleton in self.skeletons])
+            for property_type, type_properties in self.properties.items():
+                self.label_indexes[property_type] = self.embed(
+                    [label for _, label in type_properties])
+        else:
+            for property_type, type_properties in self.properties.items():
+                self.label_indexes[property_type] = levenshtein.LevenshteinIndex(
+                    [label for _, label in type_properties])
+
+        log.info(
+            f'Built hierarchical matcher with {len(self.skeletons)} skeletons and {sum(len(x) for x in self.properties.values())} properties')
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = np.array([doc.vector for doc in get_nlp().tokenizer.pipe(texts)],
+                           dtype=np.float32)
+        return normalize_rows(vectors.reshape(len(texts), -1))
+
+    def similarities(self, text: str, others: List[str]) -> np.ndarray:
+        """
+        Scores the text against each of the others with the similarity metric
+        """
+        if len(others) == 0:
+            return np.zeros(0)
+        if self.metric == 'nlp':
+            return self.embed(others) @ self.embed([text])[0]
+        distances = np.array([levenshtein.distance(text, other)
+                             for other in others])
+        return levenshtein.to_similarities(distances)
+
+    def rank_skeletons(self, words: List[str]) -> List[Tuple[float, Skeleton, str]]:
+        """
+        Returns the (score, skeleton, residual words) of each skeleton there is
+        room for in the question, best first
+        """
+        splits = [(skeleton, skeleton.split_question(words))
+                  for skeleton in self.skeletons]
+        splits = [(skeleton, split)
+                  for skeleton, split in splits if split != None]
+        if len(splits) == 0:
+            return []
+
+        if self.metric == 'nlp':
+            remainders = self.embed([split[0] for _, split in splits])
+            indices = [self.skeletons.index(skeleton) for skeleton, _ in splits]
+            scores = np.sum(remainders * self.skeleton_vectors[indices], axis=1)
+        else:
+            distances = np.array([levenshtein.distance(split[0], skeleton.text)
+                                  for skeleton, split in splits])
+            scores = levenshtein.to_similarities(distances)
+
+        order = np.argsort(-scores, kind='stable')
+        return [(float(scores[i]), splits[i][0], splits[i][1][1]) for i in order]
+
+    def rank_question(self, question: str) -> List[Tuple[float, Skeleton, str]]:
+        """
+        The first stage of matching, which doesn't depend on the entities (so
+        it can run while they're resolved)
+        """
+        return self.rank_skeletons(get_words(question))
+
+    def rank_properties(
+        self,
+        property_type: str,
+        residual: str,
+        top_k: int,
+        predicates: Union[None, Set[str]] = None
+    ) -> List[Tuple[str, str]]:
+        """
+        Returns the top k (uri, label) properties of the type for the residual
+        words, out of the predicates (if given)
+        """
+        if property_type not in self.properties or residual == '':
+            return []
+
+        type_properties = self.properties[property_type]
+        rows = None
+        if predicates != None:
+            rows = np.array([i for i, (uri, _) in enumerate(type_properties) if uri in predicates],
+                            dtype=np.int64)
+            if len(rows) == 0:
+                return []
+
+        if self.metric == 'nlp':
+            rows = np.arange(len(type_properties)) if rows is None else rows
+            scores = self.label_indexes[property_type][rows] @ self.embed([residual])[0]
+        else:
+            scored = self.label_indexes[property_type].distances(residual, None, rows)
+            rows = scored['rows']
+            scores = levenshtein.to_similarities(scored['distances'])
+
+        if len(rows) > top_k:
+            best = np.argpartition(-scores, top_k - 1)[:top_k]
+            rows, scores = rows[best], scores[best]
+        order = np.argsort(-scores, kind='stable')
+        return [type_properties[rows[i]] for i in order]
+
+    def match(
+        self,
+        question: str,
+        top_k: Union[int, None] = None,
+        predicates: Union[None, Set[str]] = None,
+        skeletons: Union[None, List[Tuple[float, Skeleton, str]]] = None
+    ) -> List[Tuple[float, str, str]]:
+        """
+        Returns the templates similar to the question, most similar first, in
+        the same (similarity, question, query) form as get_similar_templates.
+        Given the predicates of the entities, templates using any other
+        property are left out. The skeletons can be ranked beforehand with
+        rank_question
+        """
+        top_k = config.MAX_TEMPLATE_SEARCHES if top_k == None else top_k
+        candidates = {}
+
+        if skeletons == None:
+            skeletons = self.rank_question(question)
+        for _, skeleton, residual in skeletons[:config.HIERARCHICAL_SKELETONS]:
+            if not skeleton.has_property():
+                for common_type in skeleton.common_types:
+                    candidates.setdefault(
+                        (skeleton.expand(), common_statements[common_type]), None)
+                continue
+
+            for property_type in skeleton.property_types:
+                for uri, label in self.rank_properties(property_type, residual, top_k, predicates):
+                    query = common_statements['property'].replace(
+                        '{property}', f'<{uri}>')
+                    candidates.setdefault((skeleton.expand(label), query), None)
+
+        candidates = list(candidates)
+        if predicates != None:
+            # the common statements may use properties the entities don't
+            # have, and any other kind of query (None) is kept
+            allowed = predicates | {None}
+            candidates = [(template, query) for template, query in candidates
+                          if get_simple_predicate(query, prefix_map) in allowed]
+        similarities = self.similarities(
+            question, [template for template, _ in candidates])
+        templates = [(float(similarity), template, query)
+                     for similarity, (template, query) in zip(similarities, candidates)
+                     if similarity >= config.THRESHOLD]
+
+        return sorted(templates, key=lambda x: x[0], reverse=True)[:top_k]
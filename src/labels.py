@@ -0,0 +1,177 @@
+# A local index of entity labels and redirects, built from the DBpedia
+# 'labels' and 'redirects' N-Triples dumps (i.e. labels_en.ttl.bz2 and
+# redirects_en.ttl.bz2 from https://downloads.dbpedia.org). Dumps are streamed
+# line by line, so they can be ingested without decompressing them first.
+# Once built, entity URIs can be resolved without a round trip to the endpoint
+
+
+import re
+import os
+import bz2
+import gzip
+import sqlite3
+import logging
+import threading
+import config
+from itertools import islice
+from typing import IO, Iterable, Iterator, List, Tuple, Union
+
+log = logging.getLogger('logger')
+
+LABEL_PREDICATE = 'http://www.w3.org/2000/01/rdf-schema#label'
+REDIRECT_PREDICATE = 'http://dbpedia.org/ontology/wikiPageRedirects'
+
+# <subject> <predicate> <object> . OR <subject> <predicate> "literal"@lang .
+triple_regex = re.compile(
+    r'^<([^>]*)>\s+<([^>]*)>\s+(?:<([^>]*)>|"((?:[^"\\]|\\.)*)"(?:@([\w-]+)|\^\^<[^>]*>)?)\s*\.\s*$')
+escape_regex = re.compile(r'\\(U[0-9A-Fa-f]{8}|u[0-9A-Fa-f]{4}|.)')
+escapes = {'t': '\t', 'b': '\b', 'n': '\n',
+           'r': '\r', 'f': '\f', '"': '"', "'": "'", '\\': '\\'}
+
+
+def unescape(literal: str) -> str:
+    def replace(match):
+        escape = match.group(1)
+        if escape[0] in 'uU' and len(escape) > 1:
+            return chr(int(escape[1:], 16))
+        return escapes.get(escape, escape)
+
+    return escape_regex.sub(replace, literal) if '\\' in literal else literal
+
+
+def open_dump(path: str) -> IO[str]:
+    """
+    Opens a dump for reading, decompressing it on the fly if needed
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf8')
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rt', encoding='utf8')
+    return open(path, encoding='utf8')
+
+
+def parse_triples(lines: Iterable[str], predicate: str) -> Iterator[Tuple[str, str, Union[str, None]]]:
+    """
+    Yields the (subject, object, language) of each triple with the predicate
+    """
+    for line in lines:
+        match = triple_regex.match(line)
+        if match == None or match.group(2) != predicate:
+            continue
+
+        subject, _, uri, literal, language = match.groups()
+        if uri != None:
+            yield unescape(subject), unescape(uri), None
+        else:
+            yield unescape(subject), unescape(literal), language
+
+
+def in_chunks(items: Iterable, size: int) -> Iterator[List]:
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+class LabelIndex:
+    """
+    Label -> URI lookups against the local index, following redirects
+    """
+
+    def __init__(self, filename: str = None):
+        filename = config.LABEL_INDEX_FILENAME if filename == None else filename
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            f'{filename}.sqlite', check_same_thread=False)
+
+    def get_uris(self, label: str) -> Union[None, List[str]]:
+        """
+        Returns the URIs with the label, replaced by the URI they redirect to
+        if there is one, or None if the label isn't in the index
+        """
+        with self.lock:
+            rows = self.connection.execute("""
+                select coalesce(redirects.target, labels.uri) from labels
+                left join redirects on redirects.uri = labels.uri
+                where labels.label = ?
+            """, (label,)).fetchall()
+
+        if len(rows) == 0:
+            return None
+        return list(dict.fromkeys(row[0] for row in rows))
+
+
+def ingest_dumps(
+    labels_path: Union[str, None] = None,
+    redirects_path: Union[str, None] = None,
+    filename: str = None,
+    language: str = 'en'
+) -> None:
+    """
+    Builds (or rebuilds the given parts of) the local index from the dumps
+    """
+    filename = config.LABEL_INDEX_FILENAME if filename == None else filename
+    connection = sqlite3.connect(f'{filename}.sqlite')
+    connection.execute('pragma journal_mode=off')
+    connection.execute('pragma synchronous=off')
+    connection.execute(
+        'create table if not exists labels (label text, uri text)')
+    connection.execute(
+        'create table if not exists redirects (uri text primary key, target text)')
+
+    if labels_path != None:
+        log.info(f'Ingesting labels from {labels_path}')
+        connection.execute('drop index if exists labels_label')
+        connection.execute('delete from labels')
+        total = 0
+        with open_dump(labels_path) as dump:
+            triples = ((label, uri) for uri, label, lang in parse_triples(dump, LABEL_PREDICATE)
+                       if lang != None and lang.lower() == language)
+            for chunk in in_chunks(triples, config.INGEST_CHUNK_SIZE):
+                connection.executemany(
+                    'insert into labels values (?, ?)', chunk)
+                total += len(chunk)
+                log.info(f'Ingested {total} labels')
+        log.info('Indexing labels')
+        connection.execute('create index labels_label on labels (label)')
+        connection.commit()
+
+    if redirects_path != None:
+        log.info(f'Ingesting redirects from {redirects_path}')
+        connection.execute('delete from redirects')
+        total = 0
+        with open_dump(redirects_path) as dump:
+            triples = ((uri, target) for uri, target, lang in parse_triples(
+                dump, REDIRECT_PREDICATE))
+            for chunk in in_chunks(triples, config.INGEST_CHUNK_SIZE):
+                connection.executemany(
+                    'insert or replace into redirects values (?, ?)', chunk)
+                total += len(chunk)
+                log.info(f'Ingested {total} redirects')
+        connection.commit()
+
+    connection.execute('vacuum')
+    connection.close()
+    log.info(f'Saved to file "{filename}.sqlite"')
+
+
+label_index = None
+label_index_lock = threading.Lock()
+
+
+def has_label_index(filename: str = None) -> bool:
+    filename = config.LABEL_INDEX_FILENAME if filename == None else filename
+    return os.path.exists(f'{filename}.sqlite')
+
+
+def get_label_index() -> Union[None, LabelIndex]:
+    """
+    Returns the local label index, or None if one hasn't been ingested
+    """
+    global label_index
+    with label_index_lock:
+        if label_index == None and has_label_index():
+            label_index = LabelIndex()
+        return label_index
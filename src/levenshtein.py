@@ -0,0 +1,262 @@
+# Edit distances for the 'ld' similarity metric, scoring a question against
+# every template at once instead of one pair at a time in Python.
+# Questions of up to 64 characters use Myers' bit-parallel algorithm (one
+# uint64 bit per question character, with every template advanced one
+# character per step). Longer questions swap roles, with each template (they
+# are rarely over 64 characters) as the bits and the question as the text,
+# and any longer templates fall back to a row-by-row DP vectorized over them.
+# Since similarity is 1 / distance, the threshold bounds the distance (i.e.
+# 0.25 allows at most 4 edits), so templates whose length alone puts them
+# over the bound are skipped without being scored
+#   - G. Myers, A fast bit-vector algorithm for approximate string matching
+#     based on dynamic programming (1999)
+#   - H. Hyyrö, Explaining and extending the bit-parallel approximate string
+#     matching algorithm of Myers (2001)
+
+
+import math
+import threading
+import numpy as np
+from typing import Dict, Sequence, Union
+
+# above the 1 / distance of any inexact match, and still finite when serialized
+EXACT_MATCH_SIMILARITY = 2.0
+MAX_BIT_PARALLEL_LENGTH = 64
+
+
+def distance(s1: str, s2: str) -> int:
+    """
+    Returns the edit distance of two strings (Myers' algorithm on Python ints,
+    so it isn't limited to 64 characters)
+    """
+    if len(s1) < len(s2):
+        s1, s2 = s2, s1
+    m = len(s2)
+    if m == 0:
+        return len(s1)
+
+    peq = {}
+    for i, char in enumerate(s2):
+        peq[char] = peq.get(char, 0) | (1 << i)
+
+    mask = (1 << m) - 1
+    high = 1 << (m - 1)
+    vp, vn, score = mask, 0, m
+    for char in s1:
+        eq = peq.get(char, 0)
+        xv = eq | vn
+        xh = (((eq & vp) + vp) ^ vp) | eq
+        hp = vn | ~(xh | vp)
+        hn = vp & xh
+        if hp & high:
+            score += 1
+        elif hn & high:
+            score -= 1
+        hp = ((hp << 1) | 1) & mask
+        hn = (hn << 1) & mask
+        vp = (hn | ~(xv | hp)) & mask
+        vn = hp & xv
+
+    return score
+
+
+def get_max_distance(threshold: Union[float, None]) -> Union[int, None]:
+    """
+    The largest distance with a similarity (1 / distance) of at least the threshold
+    """
+    if threshold == None or threshold <= 0:
+        return None
+    return math.floor(1 / threshold + 1e-9)
+
+
+def to_similarities(distances: np.ndarray) -> np.ndarray:
+    """
+    1 / distance, where an exact match (a distance of 0) scores EXACT_MATCH_SIMILARITY
+    """
+    with np.errstate(divide='ignore'):
+        similarities = 1 / distances.astype(np.float64)
+    similarities[distances == 0] = EXACT_MATCH_SIMILARITY
+    return similarities
+
+
+class LevenshteinIndex:
+    """
+    The templates encoded once as a matrix of character codes (one row per
+    template, padded to the longest), so a question can be scored against all
+    of them with array operations
+    """
+
+    def __init__(self, texts: Sequence[str]):
+        encoded = [np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+                   for text in texts]
+        self.lengths = np.array([len(codes) for codes in encoded], dtype=np.int64)
+        width = int(self.lengths.max()) if len(encoded) > 0 else 0
+
+        points = np.concatenate(encoded) if len(encoded) > 0 else np.zeros(0, dtype=np.uint32)
+        alphabet, codes = np.unique(points, return_inverse=True)
+        self.alphabet = {chr(point): i for i, point in enumerate(alphabet.tolist())}
+        # padding uses a code past the alphabet, so it never matches
+        self.padding = len(alphabet)
+        self.codes = np.full((len(encoded), width), self.padding, dtype=np.int32)
+        rows = np.repeat(np.arange(len(encoded)), self.lengths)
+        columns = np.arange(len(points)) - np.repeat(np.cumsum(self.lengths) - self.lengths, self.lengths)
+        self.codes[rows, columns] = codes.reshape(-1)
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def distances(
+        self,
+        pattern: str,
+        max_distance: Union[int, None] = None,
+        rows: Union[np.ndarray, None] = None
+    ) -> Dict[str, np.ndarray]:
+        """
+        Returns the rows (all of them by default) within the max distance of
+        the pattern, and their distances
+        """
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows, dtype=np.int64)
+        if max_distance != None:
+            # the distance is at least the difference in length
+            rows = rows[np.abs(self.lengths[rows] - len(pattern)) <= max_distance]
+
+        if len(pattern) == 0:
+            distances = self.lengths[rows].copy()
+        elif len(pattern) <= MAX_BIT_PARALLEL_LENGTH:
+            distances = self.bit_parallel_distances(pattern, rows)
+        else:
+            distances = np.empty(len(rows), dtype=np.int64)
+            short = self.lengths[rows] <= MAX_BIT_PARALLEL_LENGTH
+            distances[short] = self.transposed_distances(pattern, rows[short])
+            distances[~short] = self.dp_distances(pattern, rows[~short])
+
+        if max_distance != None:
+            within = distances <= max_distance
+            rows, distances = rows[within], distances[within]
+        return {'rows': rows, 'distances': distances}
+
+    def bit_parallel_distances(self, pattern: str, rows: np.ndarray) -> np.ndarray:
+        m = len(pattern)
+        peq = np.zeros(self.padding + 1, dtype=np.uint64)
+        for i, char in enumerate(pattern):
+            if char in self.alphabet:
+                peq[self.alphabet[char]] |= np.uint64(1 << i)
+
+        # longest first, so the templates still being read are always a prefix
+        order = np.argsort(-self.lengths[rows], kind='stable')
+        rows = rows[order]
+        lengths = self.lengths[rows]
+        width = int(lengths.max()) if len(rows) > 0 else 0
+        codes = self.codes[rows, :width]
+        # the number of templates longer than each column
+        active = np.searchsorted(-lengths, -np.arange(1, width + 1), side='right')
+
+        one = np.uint64(1)
+        high = np.uint64(1 << (m - 1))
+        vp = np.full(len(rows), np.uint64(2 ** 64 - 1), dtype=np.uint64)
+        vn = np.zeros(len(rows), dtype=np.uint64)
+        scores = np.full(len(rows), m, dtype=np.int64)
+
+        # bits past the pattern length are never read, so aren't masked off
+        for j in range(width):
+            k = active[j]
+            eq = peq[codes[:k, j]]
+            VP, VN = vp[:k], vn[:k]
+            xv = eq | VN
+            xh = (((eq & VP) + VP) ^ VP) | eq
+            hp = VN | ~(xh | VP)
+            hn = VP & xh
+            scores[:k] += (hp & high != 0).astype(np.int64) - \
+                (hn & high != 0).astype(np.int64)
+            hp = (hp << one) | one
+            hn = hn << one
+            vp[:k] = hn | ~(xv | hp)
+            vn[:k] = hp & xv
+
+        distances = np.empty(len(rows), dtype=np.int64)
+        distances[order] = scores
+        return distances
+
+    def transposed_distances(self, pattern: str, rows: np.ndarray) -> np.ndarray:
+        """
+        Myers' algorithm with the templates (of up to 64 characters) as the
+        bit vectors, one per row, and the pattern as the text
+        """
+        lengths = self.lengths[rows]
+        codes = self.codes[rows, :MAX_BIT_PARALLEL_LENGTH]
+        if codes.shape[1] < MAX_BIT_PARALLEL_LENGTH:
+            codes = np.pad(codes, ((0, 0), (0, MAX_BIT_PARALLEL_LENGTH - codes.shape[1])),
+                           constant_values=self.padding)
+
+        # the positions of each of the pattern's characters in every template
+        peq = {}
+        for char in set(pattern):
+            if char in self.alphabet:
+                matches = np.packbits(
+                    codes == self.alphabet[char], axis=1, bitorder='little')
+                peq[char] = matches.view('<u8').reshape(-1).astype(np.uint64)
+        no_match = np.zeros(len(rows), dtype=np.uint64)
+
+        one = np.uint64(1)
+        high = np.left_shift(one, np.maximum(lengths, 1).astype(np.uint64) - one)
+        vp = np.full(len(rows), np.uint64(2 ** 64 - 1), dtype=np.uint64)
+        vn = np.zeros(len(rows), dtype=np.uint64)
+        scores = lengths.copy()
+
+        for char in pattern:
+            eq = peq.get(char, no_match)
+            xv = eq | vn
+            xh = (((eq & vp) + vp) ^ vp) | eq
+            hp = vn | ~(xh | vp)
+            hn = vp & xh
+            scores += (hp & high != 0).astype(np.int64) - \
+                (hn & high != 0).astype(np.int64)
+            hp = (hp << one) | one
+            hn = hn << one
+            vp = hn | ~(xv | hp)
+            vn = hp & xv
+
+        # an empty template is as far as the pattern is long
+        return np.where(lengths == 0, len(pattern), scores)
+
+    def dp_distances(self, pattern: str, rows: np.ndarray) -> np.ndarray:
+        """
+        Wagner-Fischer one pattern character at a time. Within a row,
+        D[j] = min(A[j], D[j - 1] + 1) is solved for every column at once as
+        j + cumulative min(A[k] - k)
+        """
+        lengths = self.lengths[rows]
+        width = int(lengths.max()) if len(rows) > 0 else 0
+        codes = self.codes[rows, :width]
+        columns = np.arange(width + 1)
+        previous = np.broadcast_to(columns, (len(rows), width + 1)).copy()
+
+        for i, char in enumerate(pattern):
+            code = self.alphabet.get(char, -1)
+            costs = (codes != code).astype(np.int64)
+            current = np.empty_like(previous)
+            current[:, 0] = i + 1
+            current[:, 1:] = np.minimum(
+                previous[:, 1:] + 1, previous[:, :-1] + costs)
+            current = columns + np.minimum.accumulate(current - columns, axis=1)
+            previous = current
+
+        return previous[np.arange(len(rows)), lengths]
+
+
+indexes: Dict[int, Dict] = {}
+indexes_lock = threading.Lock()
+
+
+def get_levenshtein_index(templates: Sequence) -> LevenshteinIndex:
+    """
+    Returns the index of the questions of the templates, built the first time
+    each list of templates is scored
+    """
+    with indexes_lock:
+        entry = indexes.get(id(templates))
+        if entry == None or entry['templates'] is not templates or len(entry['index']) != len(templates):
+            index = LevenshteinIndex([template[0] for template in templates])
+            entry = {'templates': templates, 'index': index}
+            indexes[id(templates)] = entry
+        return entry['index']
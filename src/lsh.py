@@ -0,0 +1,279 @@
+# Locality sensitive hashing indexes over the template space. Instead of
+# scoring a question against every template, the question is hashed into a
+# handful of buckets and only the templates sharing a bucket are scored.
+# Similar items collide with high probability, so recall can be traded for
+# speed with the number of tables/bands and the multi-probe radius.
+#   - HyperplaneLSH - random hyperplanes over the word vectors ('nlp' metric)
+#   - MinHashLSH - MinHash over character shingles ('ld' metric)
+# Buckets are stored as sorted key arrays so lookups are a binary search and
+# the whole index can be saved to (and loaded from) a single .npz file
+
+
+import zlib
+import logging
+import config
+import numpy as np
+from itertools import combinations
+from typing import Dict, List, Union
+
+log = logging.getLogger('logger')
+
+MERSENNE_PRIME = (1 << 31) - 1
+
+
+class LSHIndex:
+    kind = None
+
+    def __init__(self, num_items: int = 0):
+        self.num_items = num_items
+        self.keys = []
+        self.offsets = []
+        self.indices = None
+        # the fingerprint of the templates the index was built for
+        self.fingerprint = ''
+
+    def build_tables(self, codes: np.ndarray) -> None:
+        """
+        Groups the items into buckets, one table per column of codes
+        """
+        self.num_items = codes.shape[0]
+        self.keys = []
+        self.offsets = []
+        self.indices = np.argsort(codes, axis=0, kind='stable').T
+        for table, order in enumerate(self.indices):
+            keys, starts = np.unique(codes[order, table], return_index=True)
+            self.keys.append(keys)
+            self.offsets.append(np.append(starts, len(order)))
+
+    def lookup(self, codes: np.ndarray) -> np.ndarray:
+        """
+        Returns the indexes of all items sharing a bucket with the given codes,
+        where codes has shape (probes, tables)
+        """
+        candidates = []
+        for table, keys in enumerate(self.keys):
+            if len(keys) == 0:
+                continue
+            positions = np.minimum(np.searchsorted(
+                keys, codes[:, table]), len(keys) - 1)
+            for position in np.unique(positions[keys[positions] == codes[:, table]]):
+                start, end = self.offsets[table][position:position + 2]
+                candidates.append(self.indices[table][start:end])
+
+        if len(candidates) == 0:
+            return np.array([], dtype=np.int64)
+
+        return np.unique(np.concatenate(candidates))
+
+    def get_params(self) -> dict:
+        return {}
+
+    def save(self, filename: str) -> None:
+        arrays = {name: np.asarray(value)
+                  for name, value in self.get_params().items()}
+        for table, (keys, offsets) in enumerate(zip(self.keys, self.offsets)):
+            arrays[f'keys_{table}'] = keys
+            arrays[f'offsets_{table}'] = offsets
+        np.savez(f'{filename}.{self.kind}.npz', num_items=self.num_items,
+                 fingerprint=self.fingerprint, indices=self.indices, **arrays)
+        log.info(f'Saved to file "{filename}.{self.kind}.npz"')
+
+    def load_tables(self, data) -> None:
+        self.num_items = int(data['num_items'])
+        self.fingerprint = str(data['fingerprint']) if 'fingerprint' in data.files else ''
+        self.indices = data['indices']
+        self.keys = []
+        self.offsets = []
+        for table in range(len(self.indices)):
+            self.keys.append(data[f'keys_{table}'])
+            self.offsets.append(data[f'offsets_{table}'])
+
+
+class HyperplaneLSH(LSHIndex):
+    """
+    Random hyperplane LSH for cosine similarity, each table hashes a vector to
+    the sign pattern of its projections onto num_bits random hyperplanes
+    """
+    kind = 'hyperplane'
+
+    def __init__(
+        self,
+        dimensions: int,
+        num_tables: int = config.LSH_TABLES,
+        num_bits: int = config.LSH_BITS,
+        seed: int = 0
+    ):
+        super().__init__()
+        self.num_tables = num_tables
+        self.num_bits = num_bits
+        random = np.random.RandomState(seed)
+        self.planes = random.standard_normal(
+            (num_tables * num_bits, dimensions)).astype(np.float32)
+        self.weights = np.left_shift(
+            np.uint64(1), np.arange(num_bits, dtype=np.uint64))
+        # probe radius -> the masks flipping each combination of bits
+        self.flips: Dict[int, np.ndarray] = {}
+
+    def hash(self, vectors: np.ndarray) -> np.ndarray:
+        bits = (vectors @ self.planes.T > 0).reshape(
+            len(vectors), self.num_tables, self.num_bits)
+        return (bits * self.weights).sum(axis=2, dtype=np.uint64)
+
+    def build(self, vectors: np.ndarray) -> 'HyperplaneLSH':
+        self.build_tables(self.hash(vectors))
+        return self
+
+    def get_flips(self, radius: int) -> np.ndarray:
+        """
+        Returns the masks flipping every combination of 1 to radius bits
+        """
+        radius = min(radius, self.num_bits)
+        if radius not in self.flips:
+            self.flips[radius] = np.array([
+                np.bitwise_or.reduce(self.weights[list(bits)])
+                for count in range(1, radius + 1)
+                for bits in combinations(range(self.num_bits), count)
+            ], dtype=np.uint64)
+        return self.flips[radius]
+
+    def query(self, vector: np.ndarray, probes: int = None) -> np.ndarray:
+        """
+        Returns candidate item indexes for the vector. The buckets up to probes
+        bit flips away are also searched (multi-probe), raising recall without
+        adding tables
+        """
+        probes = config.LSH_PROBES if probes == None else probes
+        codes = self.hash(vector.reshape(1, -1))
+        if probes > 0:
+            flips = codes ^ self.get_flips(probes).reshape(-1, 1)
+            codes = np.concatenate([codes, flips])
+        return self.lookup(codes)
+
+    def get_params(self) -> dict:
+        return {'planes': self.planes, 'num_tables': self.num_tables, 'num_bits': self.num_bits}
+
+    @classmethod
+    def from_data(cls, data) -> 'HyperplaneLSH':
+        index = cls(data['planes'].shape[1], int(
+            data['num_tables']), int(data['num_bits']))
+        index.planes = data['planes']
+        index.load_tables(data)
+        return index
+
+
+class MinHashLSH(LSHIndex):
+    """
+    MinHash signatures over character shingles, banded so that strings with
+    a high Jaccard similarity share at least one band with high probability
+    """
+    kind = 'minhash'
+
+    def __init__(
+        self,
+        num_bands: int = config.MINHASH_BANDS,
+        num_rows: int = config.MINHASH_ROWS,
+        shingle_size: int = config.SHINGLE_SIZE,
+        seed: int = 0
+    ):
+        super().__init__()
+        self.num_bands = num_bands
+        self.num_rows = num_rows
+        self.shingle_size = shingle_size
+        random = np.random.RandomState(seed)
+        num_permutations = num_bands * num_rows
+        self.a = random.randint(
+            1, MERSENNE_PRIME, num_permutations).astype(np.uint64)
+        self.b = random.randint(
+            0, MERSENNE_PRIME, num_permutations).astype(np.uint64)
+        self.band_weights = random.randint(
+            1, 1 << 62, num_rows, dtype=np.int64).astype(np.uint64) | np.uint64(1)
+
+    def shingles(self, text: str) -> np.ndarray:
+        text = text.lower()
+        size = self.shingle_size
+        shingles = {text[i:i + size]
+                    for i in range(max(len(text) - size + 1, 1))}
+        return np.array([zlib.crc32(x.encode('utf8')) for x in shingles], dtype=np.uint64)
+
+    def signature(self, text: str) -> np.ndarray:
+        hashes = self.shingles(text)
+        permuted = (np.outer(self.a, hashes) +
+                    self.b.reshape(-1, 1)) % np.uint64(MERSENNE_PRIME)
+        return permuted.min(axis=1)
+
+    def hash(self, signatures: np.ndarray) -> np.ndarray:
+        bands = signatures.reshape(
+            len(signatures), self.num_bands, self.num_rows)
+        return (bands * self.band_weights).sum(axis=2, dtype=np.uint64)
+
+    def build(self, texts: List[str]) -> 'MinHashLSH':
+        signatures = np.array([self.signature(text) for text in texts])
+        self.build_tables(self.hash(signatures))
+        return self
+
+    def query(self, text: str) -> np.ndarray:
+        return self.lookup(self.hash(self.signature(text).reshape(1, -1)))
+
+    def get_params(self) -> dict:
+        return {
+            'a': self.a,
+            'b': self.b,
+            'band_weights': self.band_weights,
+            'num_bands': self.num_bands,
+            'num_rows': self.num_rows,
+            'shingle_size': self.shingle_size
+        }
+
+    @classmethod
+    def from_data(cls, data) -> 'MinHashLSH':
+        index = cls(int(data['num_bands']), int(
+            data['num_rows']), int(data['shingle_size']))
+        index.a = data['a']
+        index.b = data['b']
+        index.band_weights = data['band_weights']
+        index.load_tables(data)
+        return index
+
+
+index_types = {
+    'nlp': HyperplaneLSH,
+    'ld': MinHashLSH,
+}
+
+
+def build_index(templates: List, vectors: Union[np.ndarray, None] = None, metric: str = None) -> LSHIndex:
+    """
+    Builds the approximate index matching the similarity metric
+    """
+    metric = config.SIMILARITY_METRIC if metric == None else metric
+    if metric == 'nlp':
+        return HyperplaneLSH(vectors.shape[1]).build(vectors)
+
+    return MinHashLSH().build([template[0] for template in templates])
+
+
+def is_index_current(index: LSHIndex, num_items: int, fingerprint: str = None) -> bool:
+    """
+    Checks the index was built for the same templates (with the fingerprint,
+    if given) and tuning parameters
+    """
+    if index.num_items != num_items:
+        return False
+    if fingerprint != None and index.fingerprint != fingerprint:
+        return False
+    if isinstance(index, HyperplaneLSH):
+        return (index.num_tables, index.num_bits) == (config.LSH_TABLES, config.LSH_BITS)
+
+    return (index.num_bands, index.num_rows, index.shingle_size) == (
+        config.MINHASH_BANDS, config.MINHASH_ROWS, config.SHINGLE_SIZE)
+
+
+def load_index(filename: str, metric: str = None) -> Union[None, LSHIndex]:
+    metric = config.SIMILARITY_METRIC if metric == None else metric
+    index_type = index_types[metric]
+    try:
+        with np.load(f'{filename}.{index_type.kind}.npz') as data:
+            return index_type.from_data(data)
+    except:
+        log.debug(f'Could not load index from {filename}.{index_type.kind}.npz')
+        return None
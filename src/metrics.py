@@ -0,0 +1,242 @@
+# Counters and histograms for instrumenting the pipeline (stage timings, cache
+# hits, SPARQL round trips and bytes), exported as JSON or in the Prometheus
+# text format (--metrics FILE, or GET /metrics in server mode). Recording a
+# value is a dict update under a lock, so metrics are always on.
+# Questions can also be profiled one at a time with --profile, which saves a
+# cProfile (.prof) or pyinstrument (.html) profile per question
+
+
+import os
+import json
+import time
+import logging
+import threading
+import config
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterator, List, Tuple, Union
+
+log = logging.getLogger('logger')
+
+# in seconds, from a cached lookup to a slow query
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def get_label_key(labels: Union[Dict[str, str], None]) -> Tuple[Tuple[str, str], ...]:
+    return () if not labels else tuple(sorted(labels.items()))
+
+
+def format_labels(key: Tuple[Tuple[str, str], ...], extra: Dict[str, str] = None) -> str:
+    labels = list(key) + list((extra or {}).items())
+    if len(labels) == 0:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1, labels: Dict[str, str] = None) -> None:
+        key = get_label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def to_dict(self) -> List[Dict]:
+        with self.lock:
+            return [{'labels': dict(key), 'value': value} for key, value in self.values.items()]
+
+    def to_prometheus(self) -> List[str]:
+        with self.lock:
+            return [f'{self.name}{format_labels(key)} {value}' for key, value in self.values.items()]
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        # label key -> [bucket counts (the last is +Inf), sum, count]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, labels: Dict[str, str] = None) -> None:
+        key = get_label_key(labels)
+        bucket = bisect_left(self.buckets, value)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+            counts = self.values[key]
+            counts[0][bucket] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    def to_dict(self) -> List[Dict]:
+        with self.lock:
+            return [{
+                'labels': dict(key),
+                'buckets': dict(zip([str(bound) for bound in self.buckets] + ['+Inf'], counts)),
+                'sum': total,
+                'count': count
+            } for key, (counts, total, count) in self.values.items()]
+
+    def to_prometheus(self) -> List[str]:
+        lines = []
+        with self.lock:
+            for key, (counts, total, count) in self.values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(list(self.buckets) + ['+Inf'], counts):
+                    cumulative += bucket_count
+                    lines.append(
+                        f'{self.name}_bucket{format_labels(key, {"le": bound})} {cumulative}')
+                lines.append(f'{self.name}_sum{format_labels(key)} {total}')
+                lines.append(f'{self.name}_count{format_labels(key)} {count}')
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def get(self, kind, name: str, description: str, *args) -> Union[Counter, Histogram]:
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = kind(name, description, *args)
+            return self.metrics[name]
+
+    def to_dict(self) -> Dict:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {metric.name: {'type': metric.kind, 'help': metric.description, 'values': metric.to_dict()}
+                for metric in metrics}
+
+    def to_prometheus(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.description}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.to_prometheus())
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+def counter(name: str, description: str) -> Counter:
+    return registry.get(Counter, name, description)
+
+
+def histogram(name: str, description: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+    return registry.get(Histogram, name, description, buckets)
+
+
+stage_seconds = histogram(
+    'rdfqa_stage_seconds', 'Time taken by each stage of answering a question')
+
+
+def observe_timings(timings: Dict[str, float]) -> None:
+    for stage, seconds in timings.items():
+        stage_seconds.observe(seconds, {'stage': stage})
+
+
+@contextmanager
+def timed(stage: str, timings: Dict[str, float] = None) -> Iterator[None]:
+    """
+    Times the block as a stage, adding it to the timings if given
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_seconds.observe(elapsed, {'stage': stage})
+        if timings != None:
+            timings[stage] = elapsed
+
+
+def save_metrics(filename: str) -> None:
+    """
+    Saves the metrics in the Prometheus text format if the file ends in
+    .prom, otherwise as JSON
+    """
+    with open(filename, 'w', encoding='utf8') as file:
+        if filename.endswith('.prom'):
+            file.write(registry.to_prometheus())
+        else:
+            json.dump(registry.to_dict(), file, indent=2)
+    log.info(f'Saved metrics to "{filename}"')
+
+
+profile_count = 0
+profile_lock = threading.Lock()
+
+
+def get_profile_filename(extension: str) -> str:
+    global profile_count
+    with profile_lock:
+        profile_count += 1
+        count = profile_count
+    os.makedirs(config.PROFILE_DIRECTORY, exist_ok=True)
+    now = datetime.now().strftime('%Y:%m:%d-%H:%M:%S')
+    return os.path.join(config.PROFILE_DIRECTORY, f'{now}-{count}.{extension}')
+
+
+@contextmanager
+def profiled(profiler: Union[str, None] = None, details: Dict = None) -> Iterator[None]:
+    """
+    Profiles the block with cProfile or pyinstrument (if installed), saving
+    the profile to the profile directory and its filename to details['profile'].
+    Only the calling thread is profiled, so work done by the query executor
+    shows up as time spent waiting on it
+    """
+    profiler = config.PROFILE if profiler == None else profiler
+    if profiler == None:
+        yield
+        return
+
+    if profiler == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            log.error('pyinstrument is not installed (pip install pyinstrument)')
+            yield
+            return
+
+        profile = Profiler()
+        profile.start()
+        try:
+            yield
+        finally:
+            profile.stop()
+            filename = get_profile_filename('html')
+            with open(filename, 'w', encoding='utf8') as file:
+                file.write(profile.output_html())
+    else:
+        import cProfile
+
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            filename = get_profile_filename('prof')
+            profile.dump_stats(filename)
+
+    log.debug(f'Saved profile to "{filename}"')
+    if details != None:
+        details['profile'] = filename
@@ -0,0 +1,140 @@
+# Plans the queries used to try the candidate (template, entity URI) pairs of
+# a question. Most of the top ranked templates are the same simple
+# '<entity> <property> ?result' query with a different property, so instead of
+# a round trip per candidate, the property candidates of each entity are
+# merged into a single query:
+#   select ?p ?result where { values ?p { <p1> <p2> ... } <entity> ?p ?result }
+# The answers are then split back up by ?p, so the candidates can still be
+# ranked by template similarity. Any other template is run on its own. If a
+# merged query fails (or is truncated), it is split in half by property and
+# each half is tried again, down to a single property
+
+
+import re
+from typing import Dict, List, Tuple, Union
+
+# matches queries generated by templates.simple_query_template
+simple_query_regex = re.compile(
+    r'^\s*select \?result where \{\{\s*<\{\}>\s+(<[^>]+>|[\w-]*:[\w-]+)\s+\?result\s*\}\}\s*$', re.IGNORECASE)
+prefix_regex = re.compile(r'PREFIX\s+([\w-]*):\s*<([^>]*)>', re.IGNORECASE)
+
+
+def get_prefix_map(prefixes: str) -> Dict[str, str]:
+    return {prefix: uri for prefix, uri in prefix_regex.findall(prefixes)}
+
+
+def expand_predicate(predicate: str, prefix_map: Dict[str, str]) -> str:
+    """
+    Returns the full URI of a predicate, which might use a prefixed name
+    """
+    if predicate.startswith('<'):
+        return predicate[1:-1]
+    prefix, name = predicate.split(':', 1)
+    return prefix_map.get(prefix, prefix + ':') + name
+
+
+def get_simple_predicate(query_template: str, prefix_map: Dict[str, str]) -> Union[None, str]:
+    """
+    Returns the property URI of a simple property template, or None if the
+    template is any other kind of query
+    """
+    match = simple_query_regex.match(query_template)
+    return None if match == None else expand_predicate(match.group(1), prefix_map)
+
+
+class QueryUnit:
+    """
+    A query covering one or more candidates, identified by their ranks
+    """
+
+    def __init__(
+        self,
+        query: str,
+        ranks: List[int],
+        predicates: Union[Dict[str, List[int]], None] = None,
+        entity_uri: Union[str, None] = None
+    ):
+        self.query = query
+        self.ranks = ranks
+        # predicate URI -> ranks of the candidates using it, for merged queries
+        self.predicates = predicates
+        self.entity_uri = entity_uri
+
+    def split(self) -> List['QueryUnit']:
+        """
+        Splits a merged query in half by its predicates, or returns no units
+        if it can't be split
+        """
+        if self.predicates == None or len(self.predicates) < 2:
+            return []
+
+        predicates = sorted(self.predicates)
+        middle = len(predicates) // 2
+        return [merged_unit(self.entity_uri, {predicate: self.predicates[predicate] for predicate in half})
+                for half in (predicates[:middle], predicates[middle:])]
+
+    def get_answers(self, bindings: List[Dict], key: str = 'result') -> Dict[int, List[str]]:
+        """
+        Splits the bindings of the query into the answers of each candidate
+        """
+        answers = {rank: [] for rank in self.ranks}
+        for binding in bindings:
+            if self.predicates == None:
+                ranks = self.ranks
+            else:
+                ranks = self.predicates.get(binding['p']['value'], [])
+            for rank in ranks:
+                answers[rank].append(binding[key]['value'])
+
+        return answers
+
+
+def merged_query(entity_uri: str, predicates: List[str]) -> str:
+    # sorted, so the same properties always make the same (cacheable) query
+    values = ' '.join(f'<{predicate}>' for predicate in sorted(predicates))
+    return f"""select ?p ?result where {{
+        values ?p {{ {values} }}
+        <{entity_uri}> ?p ?result
+    }}"""
+
+
+def merged_unit(entity_uri: str, predicates: Dict[str, List[int]]) -> QueryUnit:
+    ranks = sorted(rank for ranks in predicates.values() for rank in ranks)
+    return QueryUnit(merged_query(entity_uri, list(predicates)), ranks, predicates, entity_uri)
+
+
+def plan_queries(
+    candidates: List[Tuple[Tuple[float, str, str], str]],
+    prefix_map: Dict[str, str]
+) -> List[QueryUnit]:
+    """
+    Groups the (template, entity URI) candidates into the queries to run,
+    ordered by the best ranked candidate each one covers
+    """
+    units = []
+    merged = {}
+
+    for rank, (template, entity_uri) in enumerate(candidates):
+        predicate = get_simple_predicate(template[2], prefix_map)
+        if predicate == None:
+            units.append(QueryUnit(template[2].format(entity_uri), [rank]))
+            continue
+
+        if entity_uri not in merged:
+            merged[entity_uri] = QueryUnit(None, [], {}, entity_uri)
+            units.append(merged[entity_uri])
+        unit = merged[entity_uri]
+        unit.ranks.append(rank)
+        unit.predicates.setdefault(predicate, []).append(rank)
+
+    for entity_uri, unit in merged.items():
+        # a single property doesn't need to be merged
+        if len(unit.predicates) == 1:
+            rank = unit.ranks[0]
+            template = candidates[rank][0]
+            unit.query = template[2].format(entity_uri)
+            unit.predicates = None
+        else:
+            unit.query = merged_query(entity_uri, list(unit.predicates))
+
+    return units
@@ -1,11 +1,14 @@
 import config
-from typing import Union, List, Dict, Tuple
-from utils import paged_query, query, parse_query_response, nlp
-from SPARQLWrapper import SPARQLWrapper, JSON
+from typing import Union, List, Dict, Tuple, Iterable, Iterator, Callable
+from utils import stream_pages, query, parse_query_response, is_partial_query, get_nlp
+from throttle import retry, retriable_errors, ProgressReporter
+from errors import SPARQLQueryError, SPARQLQueryTooLarge
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
 import re
 import json
 import os
+import time
 
 log = logging.getLogger('logger')
 
@@ -75,59 +78,255 @@ def get_number_of_property_references(uri: str) -> int:
         select (count(*) as ?count) where {{
             ?s <{uri}> ?o
         }}
-    """)
+    """, cache=False, raise_errors=True)
+
     result = query_result.convert()['results']['bindings'][0]['count']['value']
     return int(result)
 
 
+def get_number_of_property_references_batch(uris: List[str]) -> Dict[str, int]:
+    """
+    Returns the number of times each property is used in the DB, counting the
+    whole batch in a single grouped query
+    """
+    values = ' '.join(f'<{uri}>' for uri in uris)
+    query_result = query(f"""
+        select ?p (count(*) as ?count) where {{
+            values ?p {{ {values} }}
+            ?s ?p ?o
+        }} group by ?p
+    """, cache=False, raise_errors=True)
+
+    bindings = parse_query_response(query_result)  # can throw Exception
+    # Virtuoso returns partial results when it hits its time limit
+    if is_partial_query(query_result.response):
+        raise SPARQLQueryError(f'Partial result for batch of {len(uris)}')
+
+    # unused properties aren't returned by the group by
+    counts = {uri: 0 for uri in uris}
+    for binding in bindings:
+        counts[binding['p']['value']] = int(binding['count']['value'])
+    return counts
+
+
+def count_single_references(uris: List[str]) -> Dict[str, Union[int, None]]:
+    """
+    Counts the references of each property with its own query, None if it fails
+    """
+    counts = {}
+    for uri in uris:
+        try:
+            counts[uri] = retry(get_number_of_property_references, uri)
+        except Exception as error:
+            log.error(f'Could not count references for {uri}')
+            log.debug(error)
+            counts[uri] = None
+    return counts
+
+
+def count_batch_references(uris: List[str]) -> Dict[str, Union[int, None]]:
+    """
+    Counts the references of a batch of properties in one query, splitting the
+    batch in half whenever the endpoint can't answer it in one go (too many
+    rows, a timeout or a partial result)
+    """
+    if len(uris) == 1:
+        return count_single_references(uris)
+
+    try:
+        return get_number_of_property_references_batch(uris)
+    except (SPARQLQueryTooLarge,) + retriable_errors as error:
+        log.debug(f'Splitting batch of {len(uris)} properties: {error!r}')
+        half = len(uris) // 2
+        counts = count_batch_references(uris[:half])
+        counts.update(count_batch_references(uris[half:]))
+        return counts
+
+
+def count_property_references(
+    uris: List[str],
+    workers: int = None,
+    batch_size: int = None,
+    on_batch: Union[Callable[[Dict[str, Union[int, None]]], None], None] = None
+) -> Dict[str, int]:
+    """
+    Counts the references of every property, with at most `workers` queries
+    in flight at a time. Properties are counted `batch_size` at a time with
+    grouped queries (1 counts each property separately). on_batch is called
+    with the counts of each batch as it completes (None for failures).
+    Properties that fail after all retries are counted as 0 so they get
+    filtered out of the templates
+    """
+    workers = config.PROPERTY_WORKERS if workers == None else workers
+    batch_size = config.REFERENCE_COUNT_BATCH_SIZE if batch_size == None else batch_size
+    batch_size = max(batch_size, 1)
+    count = count_batch_references if batch_size > 1 else count_single_references
+    batches = [uris[i:i + batch_size] for i in range(0, len(uris), batch_size)]
+    counts = {}
+    progress = ProgressReporter(len(uris), 'property reference counts')
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(count, batch): batch for batch in batches}
+        for future in as_completed(futures):
+            batch_counts = future.result()
+            counts.update(batch_counts)
+            if on_batch != None:
+                on_batch(batch_counts)
+            progress.update(len(futures[future]))
+
+    failures = [uri for uri, value in counts.items() if value == None]
+    if len(failures) > 0:
+        log.warning(f'Failed to count references for {len(failures)} properties')
+    for uri in failures:
+        counts[uri] = 0
+
+    return counts
+
+
 def get_property_types(
     query: str,
     property_key: str,
-    label_key: str
-) -> List[Tuple]:
-    """
-    Returns a dictionary of datatype - property pairs
-    """
-    properties = []
-    results = paged_query(query)
-    num_results = len(results)
-    for index, result in enumerate(results):
-
-        uri = result[property_key]['value']
-        label = result[label_key]['value']
-        doc = nlp(label)
-        lemmas = [token.lemma_ for token in doc]
-        poss = [token.pos_ for token in doc]
-        log.debug(
-            f'Analyzing property {index} of {num_results}, {label} - {uri}')
-    # try:
-        num_references = get_number_of_property_references(uri)
-        properties.append((uri, label, num_references, lemmas, poss))
+    label_key: str,
+    progress: Union[Dict, None] = None,
+    on_page: Union[Callable[[], None], None] = None
+) -> List[Tuple[str, str]]:
+    """
+    Returns the (uri, label) pairs of the properties matching the query. The
+    progress (the pairs so far and the last seen binding) is updated after
+    each page, and a listing resumes from it if given
+    """
+    progress = {'listing': [], 'last_seen': None} if progress == None else progress
+    keys = [property_key, label_key]
+    for results in stream_pages(query, keys=keys, last_seen=progress['last_seen']):
+        progress['listing'].extend(
+            (result[property_key]['value'], result[label_key]['value']) for result in results)
+        progress['last_seen'] = {key: results[-1][key] for key in keys}
+        if on_page != None:
+            on_page()
 
-    return properties
+    return [tuple(pair) for pair in progress['listing']]
+
+
+def analyze_property_labels(
+    labels: Iterable[str],
+    batch_size: int = None,
+    n_process: int = None
+) -> Iterator[Tuple[List[str], List[str]]]:
+    """
+    Streams the (lemmas, parts of speech) of each label. Labels are processed
+    in batches, and only the tagger is needed so the parser and entity
+    recognizer are disabled
+    """
+    batch_size = config.LABEL_BATCH_SIZE if batch_size == None else batch_size
+    n_process = config.LABEL_PROCESSES if n_process == None else n_process
+    docs = get_nlp().pipe(labels, batch_size=batch_size,
+                          n_process=n_process, disable=['parser', 'ner'])
+    for doc in docs:
+        yield ([token.lemma_ for token in doc], [token.pos_ for token in doc])
+
+
+def new_properties_state() -> Dict:
+    """
+    The progress of a property crawl, used to checkpoint and resume it.
+    listings - (uri, label) pairs fetched for each property type/sub type
+    pages - the listings still being fetched, with the last binding seen
+    counts - uri -> (number of references, time it was counted)
+    """
+    return {'complete': False, 'listings': {}, 'pages': {}, 'counts': {}}
 
 
-def get_all_properties() -> Dict[str, List]:
+def get_all_properties(
+    state: Union[Dict, None] = None,
+    checkpoint: Union[Callable[[Dict], None], None] = None,
+    max_age: Union[float, None] = None
+) -> Dict[str, List]:
     """
-    Downloads and parses all properties from the DB
+    Downloads and parses all properties from the DB. If a state from an
+    interrupted crawl is given, the crawl resumes from it. If the state is from
+    a completed crawl, the listings are refreshed and only the properties that
+    are new or whose counts are older than max_age (seconds) are counted again.
+    checkpoint is called with the state after each page of a listing, and
+    periodically while counting
     """
     property_key = 'property'
     label_key = 'label'
-    properties = {}
+    state = new_properties_state() if state == None else state
+    if state['complete']:
+        state['complete'] = False
+        state['listings'] = {}
+        state['pages'] = {}
+    # checkpoints from before listings were resumable
+    state.setdefault('pages', {})
+
+    last_checkpoint = time.monotonic()
+
+    def save_checkpoint(force=False):
+        nonlocal last_checkpoint
+        now = time.monotonic()
+        if checkpoint != None and (force or now - last_checkpoint >= config.CHECKPOINT_INTERVAL):
+            checkpoint(state)
+            last_checkpoint = now
 
     for property_type, sub_types, query in types:
         log.debug('Querying for %s', property_type)
-        if property_type not in properties:
-            properties[property_type] = []
+        queries = [(property_type, query)] if sub_types == None else [
+            (f'{property_type}:{sub_type}', query.format(sub_type=sub_type)) for sub_type in sub_types]
 
-        if sub_types != None:
-            for sub_type in sub_types:
-                properties[property_type].extend(
-                    get_property_types(query.format(sub_type=sub_type), property_key, label_key))
+        for key, listing_query in queries:
+            if key in state['listings']:
+                log.debug(f'Using checkpointed listing for {key}')
+                continue
+            progress = state['pages'].setdefault(
+                key, {'listing': [], 'last_seen': None})
+            if progress['last_seen'] != None:
+                log.debug(
+                    f'Resuming listing for {key} after {len(progress["listing"])} properties')
+            state['listings'][key] = get_property_types(
+                listing_query, property_key, label_key, progress,
+                on_page=lambda: save_checkpoint(force=True))
+            del state['pages'][key]
+            save_checkpoint(force=True)
 
-        else:
-            properties[property_type].extend(
-                get_property_types(query, property_key, label_key))
+    listings = {}
+    for key, listing in state['listings'].items():
+        listings.setdefault(key.split(':')[0], []).extend(listing)
+
+    now = time.time()
+    uris = list({uri for listing in listings.values() for uri, label in listing})
+    stale = [uri for uri in uris if uri not in state['counts'] or (
+        max_age != None and now - state['counts'][uri][1] > max_age)]
+    labels = list({label for listing in listings.values()
+                   for uri, label in listing})
+    log.info(
+        f'Found {len(uris)} properties with {len(labels)} labels, {len(stale)} need counting')
+
+    def on_batch(batch_counts):
+        counted_at = time.time()
+        for uri, count in batch_counts.items():
+            # failures are left out so they are retried on the next run
+            if count != None:
+                state['counts'][uri] = (count, counted_at)
+        save_checkpoint()
+
+    # counting is network bound, so it runs in the background while the
+    # labels are analyzed
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        counts_future = executor.submit(
+            count_property_references, stale, on_batch=on_batch)
+        analyses = dict(zip(labels, analyze_property_labels(labels)))
+        counts = counts_future.result()
+
+    state['complete'] = True
+    save_checkpoint(force=True)
+
+    for uri in uris:
+        if uri not in counts:
+            counts[uri] = state['counts'][uri][0]
+
+    properties = {}
+    for property_type, listing in listings.items():
+        properties[property_type] = [
+            (uri, label, counts[uri], *analyses[label]) for uri, label in listing]
 
     return properties
 
@@ -5,13 +5,21 @@ import config
 import logging
 import pickle
 import json
+import numpy as np
 from pytictoc import TicToc
-from templates import generate_templates_from_properties
-from properties import get_all_properties, get_filtered_properties
-from benchmark import run_benchmark
+from templates import generate_templates_from_properties, generate_template_vectors
+from properties import get_all_properties, get_filtered_properties, new_properties_state
+from benchmark import run_benchmark, run_startup_benchmark
+from lsh import build_index, load_index, is_index_current
 from utils import get_answer
+from cache import log_cache_stats
+from metrics import save_metrics
+from labels import ingest_dumps
+from hierarchical import HierarchicalMatcher
+from store import save_template_store, load_template_store, has_template_store, get_fingerprint
+from server import serve
+from batch import run_batch
 from typing import Any, List, Literal, Tuple, Dict, Union
-from SPARQLWrapper import SPARQLWrapper, JSON
 from datetime import datetime
 
 logging.basicConfig(format='%(message)s')
@@ -20,8 +28,6 @@ log.info('Loaded imports...')
 
 timer = TicToc()
 
-sparql = SPARQLWrapper('http://dbpedia.org/sparql', returnFormat=JSON)
-
 
 def save_to_file(
     obj: Any,
@@ -37,13 +43,17 @@ def save_to_file(
         log.error('Must provide a file type (json or pickle)')
         sys.exit(-1)
 
+    # write to a temporary file first, so an interrupted write can't leave a
+    # corrupt cache behind
     if as_pickle:
-        with open(f"{filename}.pkl", "wb") as f:
+        with open(f"{filename}.pkl.tmp", "wb") as f:
             pickle.dump(obj, f)
+        os.replace(f"{filename}.pkl.tmp", f"{filename}.pkl")
 
     if as_json:
-        with open(f"{filename}.json", "w", encoding="utf8") as f:
+        with open(f"{filename}.json.tmp", "w", encoding="utf8") as f:
             json.dump(obj, f, ensure_ascii=False)
+        os.replace(f"{filename}.json.tmp", f"{filename}.json")
 
     log.info(f'Saved to file "{filename}.(json|pkl)"')
 
@@ -51,7 +61,7 @@ def save_to_file(
 def load_properties_from_cache(ext: Union[Literal['json'], Literal['pkl']] = 'json', filename=config.PROPERTIES_FILENAME) -> Dict:
     properties = {}
     try:
-        with open(f'{filename}.{ext}') as f:
+        with open(f'{filename}.{ext}', 'r' if ext == 'json' else 'rb') as f:
             if ext == 'json':
                 properties = json.load(f)
             else:
@@ -64,9 +74,28 @@ def load_properties_from_cache(ext: Union[Literal['json'], Literal['pkl']] = 'js
 
 
 def load_templates_from_cache(ext: Union[Literal['json'], Literal['pkl']] = 'json', filename=config.TEMPLATES_FILENAME) -> List:
+    """
+    Loads the templates from the template store. Templates cached as json or
+    pickle by older versions are converted to a store the first time
+    """
+    if has_template_store(filename):
+        templates = load_template_store(filename)
+        if templates == None:
+            sys.exit(-1)
+        return templates
+
+    if not os.path.exists(f'{filename}.{ext}') and os.path.exists(f'{filename}.pkl'):
+        ext = 'pkl'
+    log.info(f'Converting {filename}.{ext} to a template store')
+    templates = load_legacy_templates(ext, filename)
+    save_template_store(templates, filename)
+    return load_template_store(filename)
+
+
+def load_legacy_templates(ext: Union[Literal['json'], Literal['pkl']] = 'json', filename=config.TEMPLATES_FILENAME) -> List:
     templates = []
     try:
-        with open(f'{filename}.{ext}') as f:
+        with open(f'{filename}.{ext}', 'r' if ext == 'json' else 'rb') as f:
             if ext == 'json':
                 templates = json.load(f)
             else:
@@ -78,17 +107,99 @@ def load_templates_from_cache(ext: Union[Literal['json'], Literal['pkl']] = 'jso
     return templates
 
 
+def get_vectors_filename() -> str:
+    """
+    Vectors depend on the word embeddings used, so each model has its own file
+    """
+    return f'{config.TEMPLATES_FILENAME}.{config.WORD_EMBEDDINGS_SIZE}'
+
+
+def save_vectors_to_file(vectors: np.ndarray, filename=config.TEMPLATES_FILENAME, fingerprint: str = None) -> None:
+    """
+    Saves the vectors, and the fingerprint of the templates they were
+    generated from next to them
+    """
+    np.save(f'{filename}.npy', vectors)
+    if fingerprint != None:
+        with open(f'{filename}.fingerprint', 'w') as f:
+            f.write(fingerprint)
+    log.info(f'Saved to file "{filename}.npy"')
+
+
+def load_vectors_from_cache(filename=config.TEMPLATES_FILENAME, fingerprint: str = None) -> Union[None, np.ndarray]:
+    """
+    Loads the vectors, unless they were generated from templates other than
+    the ones with the fingerprint (if given)
+    """
+    if fingerprint != None:
+        try:
+            with open(f'{filename}.fingerprint') as f:
+                current = f.read().strip() == fingerprint
+        except OSError:
+            current = False
+        if not current:
+            log.info(f'Template vectors in {filename}.npy are out of date')
+            return None
+
+    try:
+        return np.load(f'{filename}.npy')
+    except:
+        log.error(f'Could not load template vectors from {filename}.npy')
+        return None
+
+
 def process_results(results, key) -> List[Tuple[str, str]]:
     return [(x["label"]['value'], x[key]['value']) for x in results]
 
 
-def update() -> None:
+def load_properties_state(incremental: bool = False) -> Union[None, Dict]:
+    """
+    Returns the state to (re)start a property crawl from. An interrupted crawl
+    is always resumed. For incremental updates, the state of the last crawl is
+    reused, falling back to the counts in the properties cache
+    """
+    if os.path.exists(f'{config.PROPERTIES_CHECKPOINT_FILENAME}.json'):
+        try:
+            with open(f'{config.PROPERTIES_CHECKPOINT_FILENAME}.json') as f:
+                state = json.load(f)
+            if not state['complete']:
+                log.info('Resuming interrupted property update')
+                return state
+            if incremental:
+                return state
+        except:
+            log.error(
+                f'Could not load checkpoint from {config.PROPERTIES_CHECKPOINT_FILENAME}.json')
+
+    if incremental and has_properties_cache():
+        properties = load_properties_from_cache()
+        counted_at = os.path.getmtime(f'{config.PROPERTIES_FILENAME}.json')
+        state = new_properties_state()
+        state['complete'] = True
+        for property_type in properties:
+            for property in properties[property_type]:
+                state['counts'][property[0]] = (property[2], counted_at)
+        return state
+
+    return None
+
+
+def save_properties_checkpoint(state: Dict) -> None:
+    save_to_file(state, filename=config.PROPERTIES_CHECKPOINT_FILENAME)
+
+
+def update(incremental: bool = False) -> None:
     """
-    Updates the templates by querying the store and saving them to file
+    Updates the templates by querying the store and saving them to file. The
+    progress is checkpointed, so an interrupted update resumes where it stopped.
+    Incremental updates only count the references of new or stale properties
     """
 
     # TODO: split this into redownload vs regenerate templates
-    properties = get_all_properties()
+    state = load_properties_state(incremental)
+    max_age = config.PROPERTY_MAX_AGE_DAYS * 24 * 60 * 60 if incremental else None
+    properties = get_all_properties(
+        state, checkpoint=save_properties_checkpoint, max_age=max_age)
     save_to_file(properties, filename=config.PROPERTIES_FILENAME)
 
     return properties
@@ -105,7 +216,14 @@ def has_templates_cache(filename=config.TEMPLATES_FILENAME):
     """
     Checks if a local copy of the templates exist
     """
-    return os.path.exists(f'{filename}.json') or os.path.exists(f'{filename}.pkl')
+    return has_template_store(filename) or os.path.exists(f'{filename}.json') or os.path.exists(f'{filename}.pkl')
+
+
+def has_vectors_cache(filename=config.TEMPLATES_FILENAME):
+    """
+    Checks if a local copy of the template vectors exist
+    """
+    return os.path.exists(f'{filename}.npy')
 
 
 def main():
@@ -113,24 +231,72 @@ def main():
     args = parser.parse_args()
     log.setLevel(logging.DEBUG if args.debug else logging.INFO)
     config.DEBUG = args.debug
+    config.ENDPOINT = args.endpoint
+    config.PROPERTY_WORKERS = args.workers
+    config.REFERENCE_COUNT_BATCH_SIZE = args.count_batch_size
+    config.PROPERTY_MAX_AGE_DAYS = args.max_age
+    config.REQUESTS_PER_SECOND = args.rate
+    config.SPARQL_TIMEOUT = args.timeout
+    config.RECORD = args.record
+    config.REPLAY = args.replay
+    config.REPLAY_LATENCY = args.replay_latency
     config.UPDATE = args.properties or args.templates
     config.BENCHMARK = args.benchmark
+    config.BENCHMARK_DATASET = args.dataset
+    config.BENCHMARK_LIMIT = args.limit
     config.SIMILARITY_METRIC = args.metric
     config.THRESHOLD = args.similarity
+    config.SEARCH_MODE = args.search
+    config.CACHE = args.cache
+    config.PRUNE_PREDICATES = args.prune
+    config.LSH_PROBES = args.probes
     config.FIGURES = args.figures
+    config.WORD_EMBEDDINGS_SIZE = args.word
+    config.SERVER_WORKERS = args.server_workers
+    config.BATCH_SIZE = args.batch_size
+    config.METRICS = args.metrics
+    config.PROFILE = args.profile
 
     log.debug(f'Started in DEBUG mode')
+
+    if args.record and args.replay:
+        log.error('Cannot record and replay queries at the same time')
+        sys.exit(-1)
+
+    if (args.record or args.replay) and config.CACHE:
+        # cached results would never reach the endpoint, so they couldn't be
+        # recorded, and would make replays depend on the state of the caches
+        log.info('Disabling the caches while recording or replaying queries')
+        config.CACHE = False
+
+    if args.startup:
+        run_startup_benchmark()
+        return
+
     log.info('Hit CTRL+D to exit')
 
     properties = None
     filtered_properties = None
     templates = []
+    vectors = None
+    index = None
+    templates_updated = False
+    # the model, vectors and index are only loaded when they will be used
+    answering = args.benchmark or args.question or args.ask or args.serve or args.batch
+    # the hierarchical matcher doesn't scan the templates, so needs no vectors
+    scanning = answering and config.SEARCH_MODE != 'hierarchical'
+
+    if args.labels_dump or args.redirects_dump:
+        log.info('Building local label index')
+        timer.tic()
+        ingest_dumps(args.labels_dump, args.redirects_dump)
+        log.info(f'Built label index in: {timer.tocvalue()}')
 
     # update properties if asked or if we're trying to update templates without a properties.json file
-    if args.properties or (args.templates and not has_properties_cache()):
+    if args.properties or args.incremental or (args.templates and not has_properties_cache()):
         log.info('Updating properties')
         timer.tic()
-        properties = update()
+        properties = update(args.incremental)
         log.info(f'Cached properties in: {timer.tocvalue()}')
 
     if args.templates or not has_templates_cache():
@@ -151,11 +317,52 @@ def main():
 
         templates = generate_templates_from_properties(filtered_properties)
         log.info(f'Generated {len(templates)} question templates')
-        save_to_file(templates, filename=config.TEMPLATES_FILENAME)
+        save_template_store(templates, config.TEMPLATES_FILENAME)
         log.info(f'Templates created in: {timer.tocvalue()}')
+        templates_updated = True
     else:
         log.debug('Loading templates from cache')
         templates = load_templates_from_cache()
+        if config.SIMILARITY_METRIC == 'nlp' and scanning and has_vectors_cache(get_vectors_filename()):
+            vectors = load_vectors_from_cache(
+                get_vectors_filename(), get_fingerprint(templates))
+
+    # the vectors are only valid for the templates they were generated from
+    if config.SIMILARITY_METRIC == 'nlp' and (scanning or templates_updated) and (
+            vectors is None or len(vectors) != len(templates)):
+        log.info('Generating template vectors')
+        timer.tic()
+        vectors = generate_template_vectors(templates)
+        save_vectors_to_file(vectors, get_vectors_filename(),
+                             get_fingerprint(templates))
+        log.info(f'Template vectors created in: {timer.tocvalue()}')
+
+    if config.SEARCH_MODE == 'approximate' and answering:
+        index_filename = config.TEMPLATES_FILENAME
+        if config.SIMILARITY_METRIC == 'nlp':
+            index_filename = get_vectors_filename()
+        if not templates_updated:
+            index = load_index(index_filename)
+        fingerprint = get_fingerprint(templates)
+        if index == None or not is_index_current(index, len(templates), fingerprint):
+            log.info('Building template index')
+            timer.tic()
+            index = build_index(templates, vectors)
+            index.fingerprint = fingerprint
+            index.save(index_filename)
+            log.info(f'Template index created in: {timer.tocvalue()}')
+
+    if config.SEARCH_MODE == 'hierarchical' and answering:
+        log.info('Building hierarchical matcher')
+        timer.tic()
+        if properties == None:
+            properties = load_properties_from_cache()
+        index = HierarchicalMatcher(get_filtered_properties(properties))
+        log.info(f'Hierarchical matcher built in: {timer.tocvalue()}')
+
+    if args.serve and (args.benchmark or args.question):
+        log.error('Cannot run the server and ask questions or run benchmarks at the same time')
+        sys.exit(-1)
 
     if args.benchmark and args.question:
         log.error('Cannot ask question and run benchmarks at the same time')
@@ -172,33 +379,48 @@ def main():
     log.info(
         f"Using '{config.SIMILARITY_METRIC}' as similarity metric, with threshold of {config.THRESHOLD}")
 
-    if args.benchmark:
-        log.info('Running benchmarks...')
-
-        run_benchmark(templates)
-
-    elif args.question:
-        answer = get_answer(args.question, templates)
-        log.info(answer)
-
-    elif args.ask:
-        while True:
-            try:
-                question = input("Ask a question:\n")
-                if question == '':
+    try:
+        if args.benchmark:
+            log.info('Running benchmarks...')
+
+            run_benchmark(templates, vectors, index, args.dataset, args.limit)
+            log_cache_stats()
+
+        elif args.question:
+            answer = get_answer(args.question, templates, vectors, index)
+            log.info(answer)
+            log_cache_stats()
+
+        elif args.batch:
+            run_batch(args.batch, templates, vectors, index)
+            log_cache_stats()
+
+        elif args.serve:
+            serve(templates, vectors, index, args.host,
+                  args.port, args.socket, args.server_workers)
+
+        elif args.ask:
+            while True:
+                try:
+                    question = input("Ask a question:\n")
+                    if question == '':
+                        continue
+                    answer = get_answer(question, templates, vectors, index)
+                    log.info(answer)
+                    log.info('')
+                except KeyboardInterrupt as interrupt:
+                    log.info('')
                     continue
-                answer = get_answer(question, templates)
-                log.info(answer)
-                log.info('')
-            except KeyboardInterrupt as interrupt:
-                log.info('')
-                continue
-            except EOFError:
-                log.info('\nExiting\n')
-                sys.exit(0)
-
-    else:
-        parser.print_help()
+                except EOFError:
+                    log.info('\nExiting\n')
+                    log_cache_stats()
+                    sys.exit(0)
+
+        else:
+            parser.print_help()
+    finally:
+        if args.metrics:
+            save_metrics(args.metrics)
 
 
 if __name__ == "__main__":
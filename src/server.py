@@ -0,0 +1,219 @@
+# A long running question answering server, so the spaCy model, templates,
+# template index and caches are loaded once and stay warm between questions.
+# Questions are answered by a fixed pool of workers, and the JSON API is
+# served over TCP or a Unix socket:
+#   POST /answer  {"question": "..."}    -> answers, with per-stage timings
+#   POST /answer  {"questions": [...]}   -> a list of the above
+#   GET  /health                         -> {"status": "ok", ...}
+#   GET  /metrics                        -> metrics in the Prometheus text format
+#   GET  /metrics.json                   -> metrics as JSON
+
+
+import os
+import json
+import logging
+import socketserver
+import config
+import metrics
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple, Union
+from utils import answer_question, get_nlp
+from cache import get_uri_cache, get_query_cache, log_cache_stats
+from labels import get_label_index
+
+log = logging.getLogger('logger')
+
+MAX_BODY_SIZE = 1024 * 1024
+
+
+class QAService:
+    """
+    Answers questions against the loaded templates on a bounded worker pool,
+    so a burst of requests queues up instead of overloading the endpoint
+    """
+
+    def __init__(
+        self,
+        templates: List,
+        vectors: Union[np.ndarray, None] = None,
+        index=None,
+        workers: int = None
+    ):
+        self.templates = templates
+        self.vectors = vectors
+        self.index = index
+        self.workers = config.SERVER_WORKERS if workers == None else workers
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+
+    def warm(self) -> None:
+        """
+        Loads everything a question needs up front, instead of on the first one
+        """
+        get_nlp()
+        get_label_index()
+        if config.CACHE:
+            get_uri_cache()
+            get_query_cache()
+
+    def answer(self, question: str) -> Dict:
+        return self.executor.submit(
+            answer_question, question, self.templates, self.vectors, self.index).result()
+
+    def answer_all(self, questions: List[str]) -> List[Dict]:
+        futures = [self.executor.submit(answer_question, question, self.templates, self.vectors, self.index)
+                   for question in questions]
+        return [future.result() for future in futures]
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=True)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    server_version = 'RDFQA/1.0'
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(self, status: int, body) -> None:
+        data = json.dumps(body, ensure_ascii=False).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, status: int, message: str) -> None:
+        self.send_json(status, {'error': message})
+
+    def read_json(self) -> Union[None, Dict]:
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_BODY_SIZE:
+            self.send_error_json(413, 'Request body too large')
+            return None
+        try:
+            body = json.loads(self.rfile.read(length).decode('utf8'))
+        except ValueError:
+            self.send_error_json(400, 'Request body must be JSON')
+            return None
+        if not isinstance(body, dict):
+            self.send_error_json(400, 'Request body must be a JSON object')
+            return None
+        return body
+
+    def send_text(self, status: int, text: str, content_type: str = 'text/plain; version=0.0.4') -> None:
+        data = text.encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', f'{content_type}; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        if self.path == '/metrics':
+            self.send_text(200, metrics.registry.to_prometheus())
+            return
+        if self.path == '/metrics.json':
+            self.send_json(200, metrics.registry.to_dict())
+            return
+        if self.path != '/health':
+            self.send_error_json(404, f'Unknown path {self.path}')
+            return
+
+        service = self.server.service
+        self.send_json(200, {
+            'status': 'ok',
+            'templates': len(service.templates),
+            'workers': service.workers,
+            'metric': config.SIMILARITY_METRIC,
+            'search': config.SEARCH_MODE
+        })
+
+    def do_POST(self) -> None:
+        if self.path != '/answer':
+            self.send_error_json(404, f'Unknown path {self.path}')
+            return
+
+        body = self.read_json()
+        if body == None:
+            return
+
+        service = self.server.service
+        try:
+            if isinstance(body.get('question'), str) and body['question'].strip() != '':
+                self.send_json(200, service.answer(body['question']))
+            elif isinstance(body.get('questions'), list) and all(isinstance(question, str) for question in body['questions']):
+                self.send_json(200, service.answer_all(body['questions']))
+            else:
+                self.send_error_json(
+                    400, 'Expected a "question" string or a "questions" list')
+        except Exception as error:
+            log.exception(error)
+            self.send_error_json(500, str(error))
+
+    def address_string(self) -> str:
+        # clients of a Unix socket don't have an address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, format: str, *args) -> None:
+        log.debug(f'{self.address_string()} - {format % args}')
+
+
+class QAHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], service: QAService):
+        super().__init__(address, RequestHandler)
+        self.service = service
+
+
+class QAUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, service: QAService):
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, RequestHandler)
+        self.service = service
+
+    def server_close(self) -> None:
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def serve(
+    templates: List,
+    vectors: Union[np.ndarray, None] = None,
+    index=None,
+    host: str = None,
+    port: int = None,
+    socket_path: Union[str, None] = None,
+    workers: int = None
+) -> None:
+    """
+    Serves the JSON API until interrupted, over a Unix socket if a path is
+    given, otherwise over TCP
+    """
+    service = QAService(templates, vectors, index, workers)
+    log.info('Warming up the model and caches')
+    service.warm()
+
+    if socket_path != None:
+        server = QAUnixServer(socket_path, service)
+        log.info(f'Serving on unix socket {socket_path}')
+    else:
+        host = config.SERVER_HOST if host == None else host
+        port = config.SERVER_PORT if port == None else port
+        server = QAHTTPServer((host, port), service)
+        log.info(f'Serving on http://{host}:{server.server_address[1]}')
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.info('\nShutting down')
+    finally:
+        server.server_close()
+        service.shutdown()
+        log_cache_stats()
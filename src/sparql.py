@@ -0,0 +1,210 @@
+# A thread safe SPARQL client. Connections to each endpoint are pooled and
+# kept alive between queries, responses are gzipped, and the number of
+# concurrent connections is bounded (requests wait for a free connection).
+# One client is shared per endpoint by everything that queries the store.
+#
+# The traffic can also be recorded (--record FILE) and replayed (--replay FILE)
+# instead of querying the endpoint, so benchmarks can run offline and give the
+# same results every time. Replayed queries can be given a fixed latency to
+# simulate the endpoint
+
+
+import json
+import time
+import logging
+import threading
+import urllib3
+import config
+import metrics
+from typing import Dict, Union
+from errors import SPARQLQueryError, SPARQLQueryRejected
+from throttle import get_rate_limiter
+from cache import DiskCache, get_cache, get_query_key
+
+log = logging.getLogger('logger')
+
+MAX_GET_QUERY_LENGTH = 2000
+
+requests_total = metrics.counter(
+    'rdfqa_sparql_requests_total', 'SPARQL round trips, by method and outcome')
+response_bytes_total = metrics.counter(
+    'rdfqa_sparql_response_bytes_total', 'Bytes of SPARQL responses received (decompressed)')
+request_seconds = metrics.histogram(
+    'rdfqa_sparql_request_seconds', 'Time taken by SPARQL round trips')
+
+
+class QueryResult:
+    """
+    The parsed JSON result of a query and its response headers. Follows the
+    interface of SPARQLWrapper's QueryResult (convert() and response.getheader)
+    """
+
+    def __init__(self, data: Dict):
+        self.data = data
+        self.response = self
+
+    def convert(self) -> Dict:
+        return self.data['body']
+
+    def getheader(self, name: str, default=None) -> Union[str, None]:
+        return self.data['headers'].get(name.lower(), default)
+
+
+class SPARQLClient:
+    def __init__(
+        self,
+        endpoint: str,
+        max_connections: int = None,
+        timeout: float = None,
+        connect_timeout: float = None
+    ):
+        self.endpoint = endpoint
+        max_connections = config.SPARQL_MAX_CONNECTIONS if max_connections == None else max_connections
+        timeout = config.SPARQL_TIMEOUT if timeout == None else timeout
+        connect_timeout = config.SPARQL_CONNECT_TIMEOUT if connect_timeout == None else connect_timeout
+        self.pool = urllib3.PoolManager(
+            maxsize=max_connections,
+            block=True,
+            retries=False,
+            timeout=urllib3.Timeout(connect=connect_timeout, read=timeout),
+            headers={
+                'Accept': 'application/sparql-results+json',
+                'Accept-Encoding': 'gzip',
+                'Connection': 'keep-alive',
+            }
+        )
+
+    def query(self, query_string: str) -> QueryResult:
+        """
+        Runs the query, raising a SPARQLQueryError if it fails (a
+        SPARQLQueryRejected if it would fail again)
+        """
+        get_rate_limiter(self.endpoint).acquire()
+        # long queries (i.e. big VALUES blocks) can exceed the max URL length
+        method = 'POST' if len(query_string) > MAX_GET_QUERY_LENGTH else 'GET'
+        start = time.perf_counter()
+        try:
+            if method == 'POST':
+                response = self.pool.request_encode_body(
+                    'POST', self.endpoint, fields={'query': query_string}, encode_multipart=False)
+            else:
+                response = self.pool.request(
+                    'GET', self.endpoint, fields={'query': query_string})
+        except urllib3.exceptions.HTTPError as error:
+            requests_total.inc(labels={'method': method, 'status': 'error'})
+            raise SPARQLQueryError(f'Request failed: {error}') from error
+        finally:
+            request_seconds.observe(time.perf_counter() - start)
+
+        requests_total.inc(
+            labels={'method': method, 'status': str(response.status)})
+        response_bytes_total.inc(len(response.data))
+
+        # other than rate limiting, 4xx errors will fail the same way every time
+        if 400 <= response.status < 500 and response.status != 429:
+            raise SPARQLQueryRejected(
+                f'HTTP {response.status}: {response.data[:500].decode("utf8", "replace")}')
+        if response.status >= 400:
+            raise SPARQLQueryError(
+                f'HTTP {response.status}: {response.data[:500].decode("utf8", "replace")}')
+
+        try:
+            body = json.loads(response.data.decode('utf8'))
+        except ValueError as error:
+            raise SPARQLQueryError(f'Invalid response: {error}') from error
+
+        headers = {name.lower(): value for name,
+                   value in response.headers.items()}
+        return QueryResult({'body': body, 'headers': headers})
+
+
+# the headers the rest of the pipeline reads (i.e. X-SPARQL-MaxRows for
+# truncated results), everything else is left out of recordings
+recorded_header_prefixes = ('x-sparql-', 'x-sql-', 'content-type')
+
+
+def get_recording(filename: str) -> DiskCache:
+    """
+    Returns the store of recorded queries, keyed the same way as the query cache
+    """
+    if filename.endswith('.sqlite'):
+        filename = filename[:-len('.sqlite')]
+    return get_cache(filename)
+
+
+class RecordingClient:
+    """
+    Passes queries through to a client, recording each response (or error)
+    """
+
+    def __init__(self, client: SPARQLClient, recording: DiskCache):
+        self.endpoint = client.endpoint
+        self.client = client
+        self.recording = recording
+
+    def query(self, query_string: str) -> QueryResult:
+        key = get_query_key(query_string, self.endpoint)
+        try:
+            result = self.client.query(query_string)
+        except SPARQLQueryError as error:
+            self.recording[key] = {
+                'error': str(error),
+                'rejected': isinstance(error, SPARQLQueryRejected)
+            }
+            raise
+
+        headers = {name: value for name, value in result.data['headers'].items()
+                   if name.startswith(recorded_header_prefixes)}
+        self.recording[key] = {'body': result.data['body'], 'headers': headers}
+        return result
+
+
+class ReplayClient:
+    """
+    Answers queries from a recording instead of the endpoint, optionally
+    waiting a fixed latency (in seconds) to simulate it. Queries that weren't
+    recorded fail like a failed request would
+    """
+
+    def __init__(self, endpoint: str, recording: DiskCache, latency: float = None):
+        self.endpoint = endpoint
+        self.recording = recording
+        self.latency = config.REPLAY_LATENCY if latency == None else latency
+
+    def query(self, query_string: str) -> QueryResult:
+        requests_total.inc(labels={'method': 'replay', 'status': 'replayed'})
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        try:
+            data = self.recording[get_query_key(query_string, self.endpoint)]
+        except KeyError:
+            log.debug(f'Query not in recording: {query_string}')
+            raise SPARQLQueryRejected('Query not in recording')
+
+        if 'error' in data:
+            if data.get('rejected', False):
+                raise SPARQLQueryRejected(data['error'])
+            raise SPARQLQueryError(data['error'])
+        return QueryResult(data)
+
+
+clients: Dict[str, Union[SPARQLClient, RecordingClient, ReplayClient]] = {}
+clients_lock = threading.Lock()
+
+
+def get_client(endpoint: str = None) -> Union[SPARQLClient, RecordingClient, ReplayClient]:
+    """
+    Returns the shared client for the endpoint, created on first use
+    """
+    endpoint = config.ENDPOINT if endpoint == None else endpoint
+    with clients_lock:
+        if endpoint not in clients:
+            if config.REPLAY != None:
+                client = ReplayClient(endpoint, get_recording(config.REPLAY))
+            else:
+                client = SPARQLClient(endpoint)
+            if config.RECORD != None:
+                client = RecordingClient(client, get_recording(config.RECORD))
+            clients[endpoint] = client
+        return clients[endpoint]
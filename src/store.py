@@ -0,0 +1,199 @@
+# A compact on-disk format for the question/query templates. Almost every
+# query is the same skeleton with a different property URI, so the skeletons
+# and property URIs are interned and each template is stored as integer
+# references to them. Every column is a .npy file in the store's directory:
+#   questions.npy, question_offsets.npy    - UTF-8 question text and offsets
+#   properties.npy, property_offsets.npy   - UTF-8 property URIs and offsets
+#   skeleton_ids.npy, property_ids.npy     - per template references
+#   skeletons.json                         - the query skeletons, and the
+#                                            fingerprint of the templates
+# The columns are memory-mapped when loading, so nothing is parsed up front
+# and the pages are shared by every process using the same store
+
+
+import os
+import re
+import json
+import shutil
+import hashlib
+import logging
+import numpy as np
+from typing import Dict, Iterator, List, Sequence, Tuple, Union
+
+log = logging.getLogger('logger')
+
+STORE_VERSION = 1
+# stands in for the property URI in a skeleton
+PROPERTY_MARKER = '\x00'
+
+iri_regex = re.compile(r'<([^<>{}\s]+)>')
+
+
+def pack_strings(strings: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the strings encoded into one UTF-8 buffer, and the offsets of
+    each string in it (string i is buffer[offsets[i]:offsets[i + 1]])
+    """
+    encoded = [string.encode('utf8') for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(string) for string in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def split_query(query: str) -> Tuple[str, Union[None, str]]:
+    """
+    Splits a query into its skeleton and property URI, if it has a single one
+    """
+    iris = set(iri_regex.findall(query))
+    if len(iris) != 1:
+        return query, None
+
+    iri = iris.pop()
+    return query.replace(f'<{iri}>', f'<{PROPERTY_MARKER}>'), iri
+
+
+def get_fingerprint(templates: Sequence) -> str:
+    """
+    Returns a hash of the templates, in order, so the files built from them
+    (vectors, indexes) can be checked against the templates they were built for
+    """
+    fingerprint = getattr(templates, 'fingerprint', None)
+    if fingerprint != None:
+        return fingerprint
+
+    digest = hashlib.sha256()
+    for question, query in templates:
+        digest.update(question.encode('utf8') + b'\x00' + query.encode('utf8') + b'\x00')
+    return digest.hexdigest()
+
+
+class TemplateStore:
+    """
+    A read only sequence of (question, query) templates backed by the columns
+    of a store, used in place of the list of templates
+    """
+
+    def __init__(self, columns: Dict[str, np.ndarray], skeletons: List[str], fingerprint: Union[str, None] = None):
+        self.questions = columns['questions']
+        self.question_offsets = columns['question_offsets']
+        self.properties = columns['properties']
+        self.property_offsets = columns['property_offsets']
+        self.skeleton_ids = columns['skeleton_ids']
+        self.property_ids = columns['property_ids']
+        self.skeletons = skeletons
+        # stores saved before fingerprints were added are hashed when loaded
+        self.fingerprint = get_fingerprint(self) if fingerprint == None else fingerprint
+
+    def __len__(self) -> int:
+        return len(self.skeleton_ids)
+
+    def get_question(self, i: int) -> str:
+        start, end = self.question_offsets[i], self.question_offsets[i + 1]
+        return self.questions[start:end].tobytes().decode('utf8')
+
+    def get_property(self, i: int) -> Union[None, str]:
+        property_id = self.property_ids[i]
+        if property_id < 0:
+            return None
+        start, end = self.property_offsets[property_id], self.property_offsets[property_id + 1]
+        return self.properties[start:end].tobytes().decode('utf8')
+
+    def get_query(self, i: int) -> str:
+        skeleton = self.skeletons[self.skeleton_ids[i]]
+        property = self.get_property(i)
+        return skeleton if property == None else skeleton.replace(PROPERTY_MARKER, property)
+
+    def __getitem__(self, i: Union[int, slice]) -> Union[Tuple[str, str], List[Tuple[str, str]]]:
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError('template index out of range')
+        return self.get_question(i), self.get_query(i)
+
+    def __iter__(self) -> Iterator[Tuple[str, str]]:
+        for i in range(len(self)):
+            yield self.get_question(i), self.get_query(i)
+
+
+def get_store_directory(filename: str) -> str:
+    return f'{filename}.store'
+
+
+def has_template_store(filename: str) -> bool:
+    return os.path.exists(os.path.join(get_store_directory(filename), 'skeletons.json'))
+
+
+def save_template_store(templates: Sequence, filename: str) -> None:
+    """
+    Saves the templates to the store, replacing it (if it exists) only once
+    the new one is complete
+    """
+    skeletons = {}
+    properties = {}
+    skeleton_ids = np.zeros(len(templates), dtype=np.int32)
+    property_ids = np.full(len(templates), -1, dtype=np.int32)
+    questions = []
+
+    for i, (question, query) in enumerate(templates):
+        questions.append(question)
+        skeleton, property = split_query(query)
+        skeleton_ids[i] = skeletons.setdefault(skeleton, len(skeletons))
+        if property != None:
+            property_ids[i] = properties.setdefault(property, len(properties))
+
+    question_buffer, question_offsets = pack_strings(questions)
+    property_buffer, property_offsets = pack_strings(list(properties))
+    columns = {
+        'questions': question_buffer,
+        'question_offsets': question_offsets,
+        'properties': property_buffer,
+        'property_offsets': property_offsets,
+        'skeleton_ids': skeleton_ids,
+        'property_ids': property_ids,
+    }
+
+    directory = get_store_directory(filename)
+    temporary = f'{directory}.tmp'
+    shutil.rmtree(temporary, ignore_errors=True)
+    os.makedirs(temporary)
+    for name, column in columns.items():
+        np.save(os.path.join(temporary, f'{name}.npy'), column)
+    with open(os.path.join(temporary, 'skeletons.json'), 'w', encoding='utf8') as f:
+        json.dump({'version': STORE_VERSION, 'skeletons': list(skeletons),
+                   'fingerprint': get_fingerprint(templates)}, f, ensure_ascii=False)
+
+    if os.path.exists(directory):
+        shutil.rmtree(f'{directory}.old', ignore_errors=True)
+        os.replace(directory, f'{directory}.old')
+        os.replace(temporary, directory)
+        shutil.rmtree(f'{directory}.old', ignore_errors=True)
+    else:
+        os.replace(temporary, directory)
+
+    log.info(
+        f'Saved {len(templates)} templates ({len(skeletons)} skeletons, {len(properties)} properties) to "{directory}"')
+
+
+def load_template_store(filename: str, mmap: bool = True) -> Union[None, TemplateStore]:
+    """
+    Loads the store, memory-mapping its columns unless asked not to
+    """
+    directory = get_store_directory(filename)
+    try:
+        with open(os.path.join(directory, 'skeletons.json'), encoding='utf8') as f:
+            data = json.load(f)
+        if data['version'] != STORE_VERSION:
+            log.error(f'Unsupported template store version {data["version"]}')
+            return None
+
+        columns = {}
+        for name in ['questions', 'question_offsets', 'properties', 'property_offsets', 'skeleton_ids', 'property_ids']:
+            columns[name] = np.load(os.path.join(directory, f'{name}.npy'),
+                                    mmap_mode='r' if mmap else None)
+    except (OSError, ValueError, KeyError) as error:
+        log.error(f'Could not load templates from "{directory}": {error}')
+        return None
+
+    return TemplateStore(columns, data['skeletons'], data.get('fingerprint'))
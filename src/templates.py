@@ -14,7 +14,9 @@
 
 
 from properties import Property
+from utils import get_nlp
 from typing import List, Tuple, Dict
+import numpy as np
 import logging
 
 log = logging.getLogger('logger')
@@ -142,4 +144,25 @@ def generate_templates_from_properties(properties: Dict[str, List[Property]]) ->
                     log.error(
                         f'Stumbled at {template}, {common_type}')
 
-    return list(questions)
+    # sorted, as set order changes between runs and the vectors and indexes
+    # built from the templates refer to them by position
+    return sorted(questions)
+
+
+def generate_template_vectors(templates: List[Template]) -> np.ndarray:
+    """
+    Embeds the question of every template once, returning a matrix of unit
+    length row vectors so matching a question becomes a single dot product
+    """
+    questions = [template[0] for template in templates]
+    nlp = get_nlp()
+
+    # only the word vectors are needed, so skip the rest of the pipeline
+    vectors = np.array(
+        [doc.vector for doc in nlp.tokenizer.pipe(questions, batch_size=1000)],
+        dtype=np.float32
+    ).reshape(len(questions), nlp.vocab.vectors_length)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+
+    return vectors / norms
@@ -0,0 +1,101 @@
+import time
+import random
+import logging
+import threading
+import config
+from typing import Any, Callable, Dict, Union
+from errors import SPARQLQueryError, SPARQLQueryRejected
+
+log = logging.getLogger('logger')
+
+# errors worth trying again, i.e. timeouts, dropped connections and 5xx/429
+# responses (the SPARQL client raises these as SPARQLQueryErrors). Rejected
+# queries are SPARQLQueryErrors too, but are never retried
+retriable_errors = (SPARQLQueryError, OSError)
+
+
+class RateLimiter:
+    """
+    Spaces out calls so no more than `rate` per second are made, shared by
+    all threads using the same endpoint
+    """
+
+    def __init__(self, rate: Union[float, None]):
+        self.interval = 0 if not rate else 1 / rate
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        if self.interval == 0:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+rate_limiters: Dict[str, RateLimiter] = {}
+rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(endpoint: str) -> RateLimiter:
+    with rate_limiters_lock:
+        if endpoint not in rate_limiters:
+            rate_limiters[endpoint] = RateLimiter(config.REQUESTS_PER_SECOND)
+        return rate_limiters[endpoint]
+
+
+def retry(func: Callable, *args, retries: int = None, backoff: float = None, **kwargs) -> Any:
+    """
+    Calls func, retrying with exponential backoff (and some jitter) if it
+    fails with a retriable error. The last error is raised if all attempts fail,
+    and a rejected query is raised straight away
+    """
+    retries = config.MAX_RETRIES if retries == None else retries
+    backoff = config.RETRY_BACKOFF if backoff == None else backoff
+
+    for attempt in range(retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except SPARQLQueryRejected:
+            raise
+        except retriable_errors as error:
+            if attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt * (1 + random.random())
+            log.debug(
+                f'Attempt {attempt + 1} failed, retrying in {delay:.1f}s: {error}')
+            time.sleep(delay)
+
+
+class ProgressReporter:
+    """
+    Logs the progress of a long running task every `interval` items
+    """
+
+    def __init__(self, total: int, name: str = 'items', interval: int = None):
+        self.total = total
+        self.name = name
+        self.interval = config.PROGRESS_INTERVAL if interval == None else interval
+        self.completed = 0
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+
+    def update(self, count: int = 1) -> None:
+        with self.lock:
+            previous = self.completed
+            self.completed += count
+            completed = self.completed
+
+        if completed // self.interval == previous // self.interval and completed != self.total:
+            return
+
+        elapsed = time.monotonic() - self.start
+        rate = completed / elapsed if elapsed > 0 else 0
+        remaining = (self.total - completed) / rate if rate > 0 else 0
+        log.info(
+            f'Processed {completed} of {self.total} {self.name} ({rate:.1f}/s, ~{remaining:.0f}s remaining)')
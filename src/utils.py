@@ -1,59 +1,69 @@
-import spacy
 import logging
 import config
 import re
-from pytictoc import TicToc
-from urllib.error import HTTPError
-from http.client import HTTPResponse
-from typing import List, Tuple, Union
-from SPARQLWrapper import SPARQLWrapper, JSON
-from spacy import displacy
-from tabulate import tabulate
+import threading
+import numpy as np
+import metrics
+import levenshtein
+from typing import Dict, Iterator, List, Set, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
 from errors import SPARQLQueryError, SPARQLQueryTooLarge
+from sparql import QueryResult, get_client
+from planner import QueryUnit, plan_queries, get_prefix_map, get_simple_predicate
+from cache import get_uri_cache, get_query_cache, get_predicate_cache, get_query_key
+from labels import get_label_index, in_chunks
 
 log = logging.getLogger("logger")
 
-sparql = SPARQLWrapper(config.ENDPOINT, returnFormat=JSON)
-
-nlp = spacy.load('en_core_web_lg')
+nlp = None
+nlp_lock = threading.Lock()
 
 regex = re.compile('<.*>')
 
 
-timer = TicToc()
+def get_nlp():
+    """
+    Returns the spaCy model, loading it on first use since it is slow to load
+    (the lg model is almost 1GB). The dependency parser is only needed to draw
+    the figures, so it is left out otherwise
+    """
+    global nlp
+    with nlp_lock:
+        if nlp == None:
+            import spacy
+            disable = [] if config.FIGURES else ['parser']
+            nlp = spacy.load(
+                f'en_core_web_{config.WORD_EMBEDDINGS_SIZE}', disable=disable)
+        return nlp
 
 
 def nlp_similarity(question: str, template: str) -> float:
+    nlp = get_nlp()
     q = nlp(question)
     t = nlp(template)
     return q.similarity(t)
 
 
 def levenshtein_distance(s1, s2):
-    if len(s1) > len(s2):
-        s1, s2 = s2, s1
-
-    distances = range(len(s1) + 1)
-    for i2, c2 in enumerate(s2):
-        distances_ = [i2+1]
-        for i1, c1 in enumerate(s1):
-            if c1 == c2:
-                distances_.append(distances[i1])
-            else:
-                distances_.append(
-                    1 + min((distances[i1], distances[i1 + 1], distances_[-1])))
-        distances = distances_
-    return distances[-1]
+    return levenshtein.distance(s1, s2)
 
 
 def ld_similarity(question: str, template: str) -> float:
-    return 1 / levenshtein_distance(question, template)
+    distance = levenshtein_distance(question, template)
+    return levenshtein.EXACT_MATCH_SIMILARITY if distance == 0 else 1 / distance
 
 
-get_similarity = nlp_similarity
-if config.SIMILARITY_METRIC == 'ld':
-    get_similarity = ld_similarity
+similarity_metrics = {
+    'nlp': nlp_similarity,
+    'ld': ld_similarity,
+}
+
+
+def get_similarity(question: str, template: str) -> float:
+    # looked up on each call, since the metric can be changed from the cli
+    return similarity_metrics[config.SIMILARITY_METRIC](question, template)
 
 
 prefixes = """
@@ -72,88 +82,439 @@ PREFIX dbo: <http://dbpedia.org/ontology/>
 PREFIX dbp: <http://dbpedia.org/property/>
 """
 
+prefix_map = get_prefix_map(prefixes)
+
 
-def paged_query(query_string: str) -> SPARQLWrapper.query:
+def execute_query(query_string: str, endpoint: str = None) -> QueryResult:
     """
-    Allows for running queries that return all of the items, not limited by the endpoints max limit
+    Sends the query as is to the endpoint through its shared client, any
+    errors are raised
     """
-    limit = 10000  # typical max for Virtuoso servers
-    results = []
-    iteration = 0
-    while True:
-        sparql.setQuery(
-            f'{query_string} limit {limit} offset {iteration * limit}'
-        )
-        query_results = sparql.query()
-        results.extend(query_results.convert()['results']['bindings'])
-        try:
-            is_incomplete_query(query_results.response)
-            break
-        except SPARQLQueryTooLarge:
-            iteration += 1
-            log.debug(
-                f'Incomplete response, fetching next {limit} at offset: {limit * iteration}')
+    return get_client(endpoint).query(query_string)
 
-    return results
 
+def escape_literal(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def keyset_query(query_string: str, keys: List[str], last_seen: Union[Dict, None], limit: int) -> str:
+    """
+    Wraps the query so it returns the page of results ordered after the last
+    seen binding, comparing the key variables in order
+    """
+    conditions = []
+    if last_seen != None:
+        for i, key in enumerate(keys):
+            terms = [f'str(?{previous}) = "{escape_literal(last_seen[previous]["value"])}"'
+                     for previous in keys[:i]]
+            terms.append(
+                f'str(?{key}) > "{escape_literal(last_seen[key]["value"])}"')
+            conditions.append('(' + ' && '.join(terms) + ')')
+
+    keyset_filter = f'filter ({" || ".join(conditions)})' if conditions else ''
+    order = ' '.join(f'str(?{key})' for key in keys)
+    return f"""select * where {{
+        {{ {query_string} }}
+        {keyset_filter}
+    }} order by {order} limit {limit}"""
+
+
+def fetch_page(query_string: str, endpoint: str = None) -> Tuple[List[Dict], bool]:
+    """
+    Returns the bindings of a single page, and if the endpoint truncated it
+    """
+    query_results = execute_query(query_string, endpoint)
+    bindings = query_results.convert()['results']['bindings']
+    try:
+        is_incomplete_query(query_results.response)
+        return bindings, False
+    except SPARQLQueryTooLarge:
+        return bindings, True
+
+
+class Immediate:
+    """
+    An already completed result, used in place of a future when not prefetching
+    """
+
+    def __init__(self, result):
+        self.value = result
 
-def query(query_string: str, endpoint: str = config.ENDPOINT) -> SPARQLWrapper.query:
+    def result(self):
+        return self.value
+
+
+def stream_query(
+    query_string: str,
+    keys: Union[List[str], None] = None,
+    page_size: int = None,
+    endpoint: str = None,
+    prefetch: bool = True
+) -> Iterator[Dict]:
+    """
+    Yields all of the bindings of a query page by page, not limited by the
+    endpoints max limit. With keys, pages are fetched using keyset pagination
+    (ordered by the keys and filtered to after the last seen binding), which
+    stays fast on large results unlike offsets. The next page is fetched in
+    the background while the caller processes the current one
+    """
+    for bindings in stream_pages(query_string, keys, page_size, endpoint, prefetch):
+        yield from bindings
+
+
+def stream_pages(
+    query_string: str,
+    keys: Union[List[str], None] = None,
+    page_size: int = None,
+    endpoint: str = None,
+    prefetch: bool = True,
+    last_seen: Union[Dict, None] = None
+) -> Iterator[List[Dict]]:
+    """
+    Yields the bindings of each page of a query, as stream_query. With keys,
+    the query can be resumed after the last seen binding of an earlier page
+    """
+    page_size = config.PAGE_SIZE if page_size == None else page_size
+
+    def page_query(page, last_seen):
+        if keys != None:
+            return keyset_query(query_string, keys, last_seen, page_size)
+        return f'{query_string} limit {page_size} offset {page * page_size}'
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        submit = executor.submit if prefetch else lambda f, *args: Immediate(f(*args))
+        page = 0
+        future = submit(fetch_page, page_query(page, last_seen), endpoint)
+        while future != None:
+            bindings, truncated = future.result()
+            future = None
+            if len(bindings) > 0 and (truncated or len(bindings) >= page_size):
+                page += 1
+                log.debug(
+                    f'Incomplete response, fetching page {page} of {page_size}')
+                future = submit(fetch_page, page_query(
+                    page, bindings[-1]), endpoint)
+
+            if len(bindings) > 0:
+                yield bindings
+
+
+def paged_query(query_string: str, endpoint: str = None) -> List[Dict]:
     """
-    Generic function to perform a query
+    Allows for running queries that return all of the items, not limited by the endpoints max limit
+    """
+    return list(stream_query(query_string, endpoint=endpoint))
+
+
+def query(query_string: str, endpoint: str = None, cache: bool = True, raise_errors: bool = False) -> QueryResult:
+    """
+    Generic function to perform a query. Results are served from the query
+    cache when possible (unless disabled for the query or with --no-cache).
+    Failed queries return None, or raise their error with raise_errors
     """
     query_string = f"""
     {prefixes}
     {query_string}
     """
 
-    if sparql.endpoint != endpoint:
-        sparql.endpoint = endpoint
-    sparql.setQuery(query_string)
+    endpoint = config.ENDPOINT if endpoint == None else endpoint
+    use_cache = cache and config.CACHE
+    if use_cache:
+        query_cache = get_query_cache()
+        key = get_query_key(query_string, endpoint)
+        try:
+            return QueryResult(query_cache[key])
+        except KeyError:
+            pass
+
     try:
-        response = sparql.query()
-        return response
-    except HTTPError as error:
+        response = execute_query(query_string, endpoint)
+    except SPARQLQueryError as error:
+        if raise_errors:
+            raise
         log.info('SPARQL query error')
         log.debug(error)
+        return None
+
+    if use_cache:
+        query_cache[key] = response.data
+    return response
 
 
 def is_similar(similarity: float, threshold: float = config.THRESHOLD):
     return similarity >= threshold
 
 
-def get_similar_templates(question: str, templates, threshold=0.8) -> List[Tuple[str, str, str]]:
-    valid_templates = []
-    for template, query in templates:
-        similarity = get_similarity(question, template)
+class TemplatePredicates:
+    """
+    The property URI of each template's query (if it is a simple property
+    template) as an integer code, so the templates using a set of properties
+    can be found with array operations
+    """
+
+    def __init__(self, templates):
+        self.predicates = {}
+        self.codes = np.full(len(templates), -1, dtype=np.int32)
+        # most queries are shared by several templates
+        query_codes = {}
+        for i, (_, query) in enumerate(templates):
+            if query not in query_codes:
+                predicate = get_simple_predicate(query, prefix_map)
+                query_codes[query] = -1 if predicate == None else self.predicates.setdefault(
+                    predicate, len(self.predicates))
+            self.codes[i] = query_codes[query]
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def get_mask(self, predicates: Set[str], rows: Union[np.ndarray, None] = None) -> np.ndarray:
+        """
+        Returns whether each of the rows (all of them by default) is a template
+        using one of the predicates, or isn't a simple property template (so
+        can't be pruned)
+        """
+        codes = self.codes if rows is None else self.codes[rows]
+        allowed = [self.predicates[predicate]
+                   for predicate in predicates if predicate in self.predicates]
+        return (codes < 0) | np.isin(codes, allowed)
+
+
+template_predicates: Dict[int, Dict] = {}
+template_predicates_lock = threading.Lock()
+
+
+def get_template_predicates(templates) -> TemplatePredicates:
+    """
+    Returns the predicates of the templates, found the first time each list
+    of templates is pruned
+    """
+    with template_predicates_lock:
+        entry = template_predicates.get(id(templates))
+        if entry == None or entry['templates'] is not templates or len(entry['predicates']) != len(templates):
+            entry = {'templates': templates,
+                     'predicates': TemplatePredicates(templates)}
+            template_predicates[id(templates)] = entry
+        return entry['predicates']
+
+
+def get_allowed_rows(templates, predicates: Union[None, Set[str]], candidates=None) -> Union[None, np.ndarray]:
+    """
+    Returns the candidate rows (all of the templates if None) left once the
+    templates using any property other than the predicates are pruned, or
+    the candidates as is without any predicates to prune by
+    """
+    if predicates == None:
+        return candidates
+    if candidates is None:
+        return np.flatnonzero(get_template_predicates(templates).get_mask(predicates))
+    candidates = np.asarray(candidates, dtype=np.int64)
+    return candidates[get_template_predicates(templates).get_mask(predicates, candidates)]
+
+
+def prune_scores(templates, scored: Dict[str, np.ndarray], predicates: Union[None, Set[str]]) -> Dict[str, np.ndarray]:
+    """
+    Leaves out the scored templates using any property other than the predicates
+    """
+    if predicates == None:
+        return scored
+    keep = get_template_predicates(templates).get_mask(predicates, scored['rows'])
+    return {'rows': scored['rows'][keep], 'similarities': scored['similarities'][keep]}
+
+
+def get_scores(rows, similarities) -> Dict[str, np.ndarray]:
+    return {'rows': np.asarray(rows, dtype=np.int64), 'similarities': np.asarray(similarities, dtype=np.float64)}
+
+
+def score_templates_by_vector(
+    question: str,
+    templates,
+    vectors: np.ndarray,
+    index=None,
+    predicates: Union[None, Set[str]] = None
+) -> Dict[str, np.ndarray]:
+    """
+    Scores the question against the precomputed normalized template vectors
+    (cosine similarity, same as Doc.similarity). With an index, only the
+    candidate templates sharing a bucket with the question are scored, and
+    with predicates, only the templates using them
+    """
+    question_vector = get_nlp().make_doc(question).vector
+    norm = np.linalg.norm(question_vector)
+    if norm == 0:
+        return get_scores([], [])
+    question_vector = question_vector / norm
+
+    candidates = None if index is None else index.query(question_vector)
+    candidates = get_allowed_rows(templates, predicates, candidates)
+    if candidates is None:
+        similarities = vectors @ question_vector
+        rows = np.flatnonzero(similarities >= config.THRESHOLD)
+        return get_scores(rows, similarities[rows])
+
+    similarities = vectors[candidates] @ question_vector
+    similar = similarities >= config.THRESHOLD
+    return get_scores(candidates[similar], similarities[similar])
+
+
+def score_templates_by_distance(
+    question: str,
+    templates,
+    index=None,
+    predicates: Union[None, Set[str]] = None
+) -> Dict[str, np.ndarray]:
+    """
+    Scores the question against every template (or the candidates found by
+    the index, and using the predicates) at once with the edit distance
+    engine. Templates further than the threshold allows are cut off without
+    being fully scored
+    """
+    rows = None if index is None else index.query(question)
+    rows = get_allowed_rows(templates, predicates, rows)
+    scored = levenshtein.get_levenshtein_index(templates).distances(
+        question, levenshtein.get_max_distance(config.THRESHOLD), rows)
+
+    similarities = levenshtein.to_similarities(scored['distances'])
+    similar = similarities >= config.THRESHOLD
+    return get_scores(scored['rows'][similar], similarities[similar])
+
+
+def score_templates(
+    question: str,
+    templates,
+    vectors: Union[np.ndarray, None] = None,
+    index=None,
+    predicates: Union[None, Set[str]] = None
+) -> Dict[str, np.ndarray]:
+    """
+    Returns the rows of the templates at least as similar to the question as
+    the threshold, and their similarities. In 'approximate' search mode the
+    LSH index (if given) limits the templates that are scored, otherwise
+    every template is scored exactly. Given the predicates of the entities,
+    property templates using any other property are pruned before scoring
+    """
+    if config.SEARCH_MODE != 'approximate':
+        index = None
+
+    if vectors is not None and config.SIMILARITY_METRIC == 'nlp':
+        return score_templates_by_vector(question, templates, vectors, index, predicates)
+
+    if config.SIMILARITY_METRIC == 'ld':
+        return score_templates_by_distance(question, templates, index, predicates)
+
+    candidates = None if index is None else index.query(question)
+    candidates = get_allowed_rows(templates, predicates, candidates)
+    if candidates is None:
+        candidates = range(len(templates))
+    rows = []
+    similarities = []
+    for i in candidates:
+        similarity = get_similarity(question, templates[i][0])
         if is_similar(similarity):
-            valid_templates.append((similarity, template, query))
+            rows.append(i)
+            similarities.append(similarity)
+
+    return get_scores(rows, similarities)
+
+
+def select_top_templates(
+    templates,
+    scored: Dict[str, np.ndarray],
+    top_k: Union[int, None] = None
+) -> List[Tuple[float, str, str]]:
+    """
+    Returns the top k of the scored templates, most similar first (ties in
+    template order)
+    """
+    rows, similarities = scored['rows'], scored['similarities']
+    order = np.argsort(-similarities, kind='stable')[:top_k]
+
+    return [(float(similarities[i]), templates[rows[i]][0], templates[rows[i]][1]) for i in order]
+
+
+def get_similar_templates(
+    question: str,
+    templates,
+    vectors: Union[np.ndarray, None] = None,
+    top_k: Union[int, None] = None,
+    index=None,
+    predicates: Union[None, Set[str]] = None
+) -> List[Tuple[float, str, str]]:
+    """
+    Returns the templates similar to the question, most similar first. In
+    'hierarchical' search mode the index is the matcher that builds the
+    templates from the skeletons and properties, otherwise the templates are
+    scored by score_templates
+    """
+    if config.SEARCH_MODE == 'hierarchical' and index is not None:
+        return index.match(question, top_k, predicates)
 
-    return sorted(valid_templates, key=lambda x: x[0], reverse=True)
+    return select_top_templates(
+        templates, score_templates(question, templates, vectors, index, predicates), top_k)
 
 
-def check_invalid_query(response: HTTPResponse) -> bool:
+def get_similar_templates_batch(
+    questions: List[str],
+    templates,
+    vectors: Union[np.ndarray, None] = None,
+    top_k: Union[int, None] = None,
+    index=None,
+    predicates: Union[None, List[Union[None, Set[str]]]] = None
+) -> List[List[Tuple[float, str, str]]]:
+    """
+    Returns the similar templates of each question, pruned by its predicates
+    (if given). With template vectors (and exact search), the whole batch is
+    scored with a single matrix product
+    """
+    predicates = [None] * len(questions) if predicates == None else predicates
+    if vectors is None or config.SIMILARITY_METRIC != 'nlp' or (
+            config.SEARCH_MODE in ('approximate', 'hierarchical') and index is not None):
+        return [get_similar_templates(question, templates, vectors, top_k, index, question_predicates)
+                for question, question_predicates in zip(questions, predicates)]
+
+    if len(questions) == 0:
+        return []
+
+    question_vectors = np.array(
+        [doc.vector for doc in get_nlp().tokenizer.pipe(questions)], dtype=np.float32)
+    norms = np.linalg.norm(question_vectors, axis=1, keepdims=True)
+    question_vectors = np.divide(
+        question_vectors, norms, out=np.zeros_like(question_vectors), where=norms > 0)
+
+    results = []
+    for i, similarities in enumerate(question_vectors @ vectors.T):
+        if norms[i, 0] == 0:
+            results.append([])
+            continue
+        rows = np.flatnonzero(similarities >= config.THRESHOLD)
+        scored = prune_scores(templates, get_scores(rows, similarities[rows]), predicates[i])
+        results.append(select_top_templates(templates, scored, top_k))
+
+    return results
+
+
+def check_invalid_query(response: QueryResult) -> bool:
     return not is_incomplete_query(response) or is_partial_query(response)
 
 
-def is_incomplete_query(response: HTTPResponse) -> bool:
+def is_incomplete_query(response: QueryResult) -> bool:
     incomplete = response.getheader('X-SPARQL-MaxRows') != None
     if incomplete:
         raise SPARQLQueryTooLarge
     return incomplete
 
 
-def is_partial_query(response: HTTPResponse) -> bool:
+def is_partial_query(response: QueryResult) -> bool:
     partial = response.getheader('X-SQL-State') != None
     if partial:
         log.warn('Partial response!')
     return partial
 
 
-def process_results(results: SPARQLWrapper.query, key) -> List[Tuple[str, str]]:
+def process_results(results: QueryResult, key) -> List[Tuple[str, str]]:
     return [(x["label"]["value"], x[key]["value"]) for x in results]
 
 
-def parse_query_response(query_results: SPARQLWrapper.query) -> List[str]:
+def parse_query_response(query_results: QueryResult) -> List[str]:
     bindings = query_results.convert()['results']['bindings']
     check_invalid_query(query_results.response)  # can throw Exception
     return bindings
@@ -168,8 +529,13 @@ def replace_token(token) -> str:
 
 
 def convert_question_to_template(question: str) -> Tuple[str, List[any]]:
+    return convert_doc_to_template(get_nlp()(question))
+
 
-    sentence = nlp(question)
+def convert_doc_to_template(sentence) -> Tuple[str, List[any]]:
+    """
+    Converts a parsed question (i.e. from nlp.pipe) into its template
+    """
 
     # strip out date entities... we want to be able to compare sentences
     entities = [entity for entity in sentence.ents if entity.label_ != 'DATE']
@@ -200,6 +566,9 @@ def convert_question_to_template(question: str) -> Tuple[str, List[any]]:
     template_string = ' '.join(template_tokens)
 
     if config.FIGURES:
+        from spacy import displacy
+        from tabulate import tabulate
+
         token_table = [[
             token.text,
             token.prob,
@@ -239,14 +608,77 @@ def convert_question_to_template(question: str) -> Tuple[str, List[any]]:
         output_path = Path("sentence-deps.svg")
         output_path.open("w", encoding="utf-8").write(svg)
 
-        log.debug(question)
+        log.debug(sentence.text)
         log.debug(tag_string)
         log.debug(template_string)
 
     return (template_string, entities)
 
 
-def get_uri(label: str) -> Union[None, List[str]]:
+def get_label_uris(labels: List[str]) -> Dict[str, Union[None, List[str]]]:
+    """
+    Returns the URIs of the entities with each label, checking the local label
+    index and then the URI cache before querying the endpoint for the rest,
+    all in one query. Labels without a match are cached too
+    """
+    uris = {}
+    missing = []
+    label_index = get_label_index()
+    cache = get_uri_cache() if config.CACHE else None
+    for label in dict.fromkeys(labels):
+        if label_index != None:
+            label_uris = label_index.get_uris(label)
+            if label_uris != None:
+                log.debug(f'Found uris for {label} in label index')
+                uris[label] = label_uris
+                continue
+
+        if cache != None:
+            try:
+                uris[label] = cache[label]
+                log.debug(f'Using cached uris for {label}')
+                continue
+            except KeyError:
+                pass
+
+        missing.append(label)
+
+    for chunk in in_chunks(missing, config.URI_LOOKUP_BATCH_SIZE):
+        uris.update(lookup_label_uris(chunk, cache))
+
+    return uris
+
+
+def lookup_label_uris(labels: List[str], cache=None) -> Dict[str, Union[None, List[str]]]:
+    """
+    Looks up the URIs of the labels in one query, splitting it in half when it
+    fails so that one bad label doesn't fail the whole batch
+    """
+    found = lookup_uris(labels)
+    if found == None and len(labels) > 1:
+        log.info(f'Splitting uri lookup of {len(labels)} labels')
+        middle = len(labels) // 2
+        uris = lookup_label_uris(labels[:middle], cache)
+        uris.update(lookup_label_uris(labels[middle:], cache))
+        return uris
+
+    uris = {}
+    for label in labels:
+        # labels that couldn't be looked up aren't cached, so are retried
+        if found == None:
+            uris[label] = None
+            continue
+        uris[label] = found.get(label)
+        if cache != None:
+            cache[label] = uris[label]
+
+    return uris
+
+
+def lookup_uris(labels: List[str]) -> Union[None, Dict[str, List[str]]]:
+    """
+    Returns the URIs of the labels that have a match, or None if the query failed
+    """
     # loose_match = f"""SELECT DISTINCT * WHERE {{
     #     ?labelUri rdfs:label ?label .
     #     FILTER (
@@ -256,20 +688,23 @@ def get_uri(label: str) -> Union[None, List[str]]:
     #     optional {{?labelUri dbo:wikiPageRedirects ?redirectUri}}
     # }}"""
 
+    values = ' '.join(f'"{escape_literal(label)}"@en' for label in labels)
     exact_match = f"""SELECT DISTINCT * WHERE {{
+        VALUES ?label {{ {values} }}
         ?labelUri rdfs:label ?label .
-        filter (
-            ?label = "{label}"@en
-        )
         optional {{?labelUri dbo:wikiPageRedirects ?redirectUri}}
     }}"""
 
-    log.debug(f'Getting uris for {label}')
+    log.debug(f'Getting uris for {labels}')
     result = query(exact_match)
+    if result == None:
+        return None
 
-    bindings = parse_query_response(result)  # can throw Exception
-    if len(bindings) == 0:
-        log.debug(f'No matching uri for {label}')
+    try:
+        bindings = parse_query_response(result)
+    except (SPARQLQueryError, SPARQLQueryTooLarge) as error:
+        log.info('Could not get the uris of the labels')
+        log.debug(error)
         return None
 
     # a label should have a URI associated with it (unless there is no match)
@@ -277,30 +712,143 @@ def get_uri(label: str) -> Union[None, List[str]]:
     # i.e. J.K. Rowling is a valid label, but returns J.K._Rowling, which
     # redirects to the real entity, J. K. Rowling (J._K._Rowling)
     # SO, return the URI UNLESS a redirect URI is present
-    uris = []
-
+    uris = {}
     for binding in bindings:
         key = 'labelUri' if 'redirectUri' not in binding else 'redirectUri'
-        uris.append(get_result_value(binding, key=key))
-
+        label_uris = uris.setdefault(get_result_value(binding, key='label'), [])
+        uri = get_result_value(binding, key=key)
+        if uri not in label_uris:
+            label_uris.append(uri)
+
+    for label in labels:
+        if label not in uris:
+            log.debug(f'No matching uri for {label}')
     return uris
 
 
-def get_uris(entities) -> List[str]:
-    uris = []
-    for entity in entities:
-        # If the KB entiter linker is used, entities may have corresponding URIs
-        # already in spaCy. If not, hit the DB and try to find it
-        id = entity.kb_id_
-        if id == '':
-            id = get_uri(entity.text)
+def get_uris(entities) -> Dict[str, List[str]]:
+    """
+    Returns the URIs of each entity (by its text) that has any, looking up
+    the labels of all of the entities together
+    """
+    # If the KB entiter linker is used, entities may have corresponding URIs
+    # already in spaCy. If not, hit the DB and try to find them
+    label_uris = get_label_uris(
+        [entity.text for entity in entities if entity.kb_id_ == ''])
 
-        if id != None:
-            uris.append(id)
+    uris = {}
+    for entity in entities:
+        entity_uris = [entity.kb_id_] if entity.kb_id_ != '' else label_uris.get(entity.text)
+        if entity_uris != None:
+            uris.setdefault(entity.text, entity_uris)
 
     return uris
 
 
+def flatten_uris(uris: Dict[str, List[str]]) -> List[str]:
+    """
+    Returns the URIs of all of the entities, without duplicates
+    """
+    return list(dict.fromkeys(uri for entity_uris in uris.values() for uri in entity_uris))
+
+
+def get_entity_predicates(uris: List[str]) -> Dict[str, Union[None, Set[str]]]:
+    """
+    Returns the distinct predicates each entity is the subject of, checking
+    the predicate cache first and fetching the rest with one query per
+    URI_LOOKUP_BATCH_SIZE entities. The predicates of an entity are None if
+    they couldn't all be fetched
+    """
+    predicates = {}
+    missing = []
+    cache = get_predicate_cache() if config.CACHE else None
+    for uri in dict.fromkeys(uris):
+        if cache != None:
+            try:
+                predicates[uri] = set(cache[uri])
+                continue
+            except KeyError:
+                pass
+        missing.append(uri)
+
+    for chunk in in_chunks(missing, config.URI_LOOKUP_BATCH_SIZE):
+        predicates.update(lookup_entity_predicates(chunk, cache))
+
+    return predicates
+
+
+def lookup_entity_predicates(uris: List[str], cache=None) -> Dict[str, Union[None, Set[str]]]:
+    """
+    Looks up the predicates of the entities in one query, splitting it in half
+    when it fails or is truncated so that one bad chunk doesn't stop the
+    predicates of the others from being pruned with
+    """
+    fetched = lookup_predicates(uris)
+    if fetched == None and len(uris) > 1:
+        log.info(f'Splitting predicate lookup of {len(uris)} uris')
+        middle = len(uris) // 2
+        predicates = lookup_entity_predicates(uris[:middle], cache)
+        predicates.update(lookup_entity_predicates(uris[middle:], cache))
+        return predicates
+
+    predicates = {}
+    for uri in uris:
+        # entities that couldn't be looked up aren't cached, so are retried
+        if fetched == None:
+            predicates[uri] = None
+            continue
+        predicates[uri] = fetched.get(uri, set())
+        if cache != None:
+            cache[uri] = sorted(predicates[uri])
+
+    return predicates
+
+
+def lookup_predicates(uris: List[str]) -> Union[None, Dict[str, Set[str]]]:
+    """
+    Returns the predicates of each entity, or None if the query failed or its
+    result may be missing some of them
+    """
+    values = ' '.join(f'<{uri}>' for uri in uris)
+    predicates_query = f"""SELECT DISTINCT ?entity ?predicate WHERE {{
+        VALUES ?entity {{ {values} }}
+        ?entity ?predicate ?object .
+    }}"""
+
+    log.debug(f'Getting predicates for {len(uris)} uris')
+    # cached per entity by get_entity_predicates instead
+    result = query(predicates_query, cache=False)
+    if result == None:
+        return None
+
+    try:
+        bindings = parse_query_response(result)
+    except (SPARQLQueryError, SPARQLQueryTooLarge) as error:
+        log.info('Could not get the predicates of the entities')
+        log.debug(error)
+        return None
+    # a timed out query (or one cut off at the endpoint's row limit) may be
+    # missing some of the predicates
+    if is_partial_query(result.response) or len(bindings) >= config.PAGE_SIZE:
+        return None
+
+    predicates = {}
+    for binding in bindings:
+        predicates.setdefault(get_result_value(binding, key='entity'), set()).add(
+            get_result_value(binding, key='predicate'))
+    return predicates
+
+
+def get_allowed_predicates(predicates: Dict[str, Union[None, Set[str]]]) -> Union[None, Set[str]]:
+    """
+    Returns the predicates of any of the entities, or None (nothing can be
+    pruned) if the predicates of an entity are unknown
+    """
+    if len(predicates) == 0 or any(x == None for x in predicates.values()):
+        return None
+    return set().union(*predicates.values())
+
+
 def get_result_value(result, key="result") -> str:
     return result[key]["value"]
 
@@ -312,75 +860,279 @@ def replace_uris_in_query(query, uris) -> str:
 apostrophe_regex = re.compile("'s\s")
 
 
-def get_answer(question: str, templates: List) -> Union[None, List[str]]:
-    # get question as template
-    timer.tic()
-    if config.STRIP_POSSESSIVE_APOSTROPHES:
-        question = question.replace("'s ", ' ')
-    question_template, entities = convert_question_to_template(question)
+query_executor = None
+query_executor_lock = threading.Lock()
+
+
+def get_query_executor() -> ThreadPoolExecutor:
+    """
+    Returns the pool used to run candidate queries, created on first use
+    """
+    global query_executor
+    with query_executor_lock:
+        if query_executor == None:
+            query_executor = ThreadPoolExecutor(
+                max_workers=config.QUERY_WORKERS)
+        return query_executor
+
+
+def has_predicate(template: Tuple[float, str, str], predicates: Union[None, Set[str]]) -> bool:
+    """
+    Whether the entity with the predicates (if known) could have an answer
+    for a simple property template
+    """
+    if predicates == None:
+        return True
+    predicate = get_simple_predicate(template[2], prefix_map)
+    return predicate == None or predicate in predicates
+
+
+def get_candidates(
+    templates: List,
+    uris: Dict[str, List[str]],
+    predicates: Union[None, Dict[str, Union[None, Set[str]]]] = None
+) -> List[Tuple[Tuple[float, str, str], str]]:
+    """
+    Returns the (template, entity URI) pairs to try, best ranked first, leaving
+    out the pairs using a property the entity doesn't have
+    """
+    predicates = {} if predicates == None else predicates
+    candidates = ((template, entity_uri)
+                  for template in templates
+                  for entity_uri in flatten_uris(uris)
+                  if has_predicate(template, predicates.get(entity_uri)))
+    return list(islice(candidates, config.MAX_TEMPLATE_SEARCHES))
+
+
+def run_query_unit(unit: QueryUnit) -> Dict[int, List[str]]:
+    """
+    Runs the query of a planned unit, returning the answers of each candidate
+    it covers (if any)
+    """
+    log.debug(unit.query)
+    results = query(unit.query)
+    if results != None:
+        try:
+            bindings = parse_query_response(results)
+            # a merged query that timed out may be missing the answers of some
+            # of its properties
+            if unit.predicates == None or not is_partial_query(results.response):
+                return unit.get_answers(bindings)
+        except (SPARQLQueryError, SPARQLQueryTooLarge) as error:
+            log.info('Could not find matching entity URI')
+            log.debug(error)
+
+    # each half of a failed merged query may still succeed on its own
+    answers = {}
+    halves = unit.split()
+    if len(halves) > 0:
+        log.info(
+            f'Splitting merged query of {len(unit.predicates)} properties')
+    for half in halves:
+        answers.update(run_query_unit(half))
+    return answers
+
+
+def find_answer(candidates: List[Tuple[Tuple[float, str, str], str]]) -> Union[None, Tuple[int, List[str]]]:
+    """
+    Runs the candidate queries concurrently (best ranked are started first),
+    returning the rank and answers of the best ranked candidate with any. An answer is
+    returned as soon as every better ranked candidate has finished, and the
+    queries that haven't started yet are cancelled. Candidates using simple
+    property templates are merged into a single query per entity
+    """
+    executor = get_query_executor()
+    if config.MERGE_QUERIES:
+        units = plan_queries(candidates, prefix_map)
+    else:
+        units = [QueryUnit(template[2].format(entity_uri), [rank])
+                 for rank, (template, entity_uri) in enumerate(candidates)]
+
+    futures = {}
+    for unit in units:
+        future = executor.submit(run_query_unit, unit)
+        for rank in unit.ranks:
+            futures[rank] = future
+
+    try:
+        for rank in range(len(candidates)):
+            answers = futures[rank].result().get(rank, [])
+            if len(answers) > 0:
+                return rank, answers
+    finally:
+        # queries already in flight finish in the background, and are ignored
+        for future in futures.values():
+            future.cancel()
+
+    return None
+
+
+def describe_match(template: Tuple[float, str, str], entity_uri: str) -> Dict:
+    return {
+        'similarity': float(template[0]),
+        'template': template[1],
+        'query': template[2].format(entity_uri),
+        'predicate': get_simple_predicate(template[2], prefix_map),
+        'uri': entity_uri
+    }
+
+
+questions_total = metrics.counter(
+    'rdfqa_questions_total', 'Questions answered, by how far they got')
+
+
+def answer_question(
+    question: str,
+    templates: List,
+    vectors: Union[np.ndarray, None] = None,
+    index=None
+) -> Dict:
+    """
+    Answers the question, returning the answers (None if no URIs or templates
+    were found, [] if no candidate had any answers) along with how they were
+    found and the time taken by each stage (in seconds). The entities (and
+    predicates) stages run alongside the templates one, so the stages can add
+    up to more than the total
+    """
+    details = {
+        'question': question,
+        'template': None,
+        'entities': [],
+        'uris': {},
+        'match': None,
+        'answers': None,
+        'timings': {}
+    }
+
+    with metrics.profiled(details=details), metrics.timed('total', details['timings']):
+        result = find_question_answer(
+            question, templates, vectors, index, details)
+
+    questions_total.inc(labels={'result': result})
+    return details
+
+
+def resolve_entities(entities, timings: Dict[str, float]) -> Tuple[Dict[str, List[str]], Dict[str, Union[None, Set[str]]]]:
+    """
+    Returns the URIs of the entities, and the predicates of those URIs (unless
+    pruning is off)
+    """
+    with metrics.timed('entities', timings):
+        uris = get_uris(entities)
     log.info(
-        f'Converted question to "{question_template}" with entities {entities} in: {timer.tocvalue()}')
+        f'Found {len(flatten_uris(uris))} URIs for entities {entities} in: {timings["entities"]}')
+
+    predicates = {}
+    if config.PRUNE_PREDICATES and len(uris) > 0:
+        # to prune templates the entities can't answer
+        with metrics.timed('predicates', timings):
+            predicates = get_entity_predicates(flatten_uris(uris))
+        log.info(
+            f'Found the predicates of {len(predicates)} URIs in: {timings["predicates"]}')
+
+    return uris, predicates
+
+
+def find_question_answer(
+    question: str,
+    templates: List,
+    vectors: Union[np.ndarray, None],
+    index,
+    details: Dict
+) -> str:
+    """
+    Runs each stage of answering the question, filling in the details. Returns
+    how far the question got. Once the question is parsed, its entities are
+    resolved while the templates are scored (or in 'hierarchical' mode, while
+    the skeletons are ranked). The candidate queries wait for both stages to
+    finish, since the candidates are ranked across the URIs of every entity
+    and their predicates
+    """
+    timings = details['timings']
 
-    # get URIs for entities
-    # TODO: not a good way to handle multiple entities...
-    timer.tic()
-    uris = get_uris(entities)
+    # get question as template
+    with metrics.timed('parse', timings):
+        if config.STRIP_POSSESSIVE_APOSTROPHES:
+            question = question.replace("'s ", ' ')
+        question_template, entities = convert_question_to_template(question)
+    details['template'] = question_template
+    details['entities'] = [entity.text for entity in entities]
+    log.info(
+        f'Converted question to "{question_template}" with entities {entities} in: {timings["parse"]}')
+
+    if len(entities) == 0:
+        log.info('Could not find any entities in the question')
+        return 'no_uris'
+
+    # the entities are looked up (network bound) on the query executor while
+    # the templates are scored (CPU bound) on this thread. This deliberately
+    # gives up pruning before scoring (get_similar_templates and the batch
+    # mode still do) as the scores can't wait for the predicates, so all of
+    # the templates are scored and pruned after, which leaves the same ones
+    resolving = get_query_executor().submit(resolve_entities, entities, timings)
+    hierarchical = config.SEARCH_MODE == 'hierarchical' and index is not None
+    if hierarchical:
+        # only the properties the entities have are ranked, after the skeletons
+        with metrics.timed('skeletons', timings):
+            skeletons = index.rank_question(question_template)
+    else:
+        log.info('Scoring templates...')
+        with metrics.timed('templates', timings):
+            scored = score_templates(question_template, templates, vectors, index)
+
+    uris, predicates = resolving.result()
+    details['uris'] = uris
 
     if len(uris) == 0:
         log.info('Could not find any matching URIs for the subject')
-        return None
+        return 'no_uris'
 
-    log.info(
-        f'Found {len(uris)} URIs for entities {entities} in: {timer.tocvalue()}')
     log.debug(uris)
 
-    #  find similar templates
-    log.info('Getting similar templates...')
-    timer.tic()
-    templates = get_similar_templates(question_template, templates)
+    #  find similar templates the entities could answer
+    allowed = get_allowed_predicates(predicates)
+    if hierarchical:
+        with metrics.timed('templates', timings):
+            templates = index.match(
+                question_template, config.MAX_TEMPLATE_SEARCHES, allowed, skeletons)
+    else:
+        with metrics.timed('ranking', timings):
+            templates = select_top_templates(
+                templates, prune_scores(templates, scored, allowed), config.MAX_TEMPLATE_SEARCHES)
     # templates is (similarity, question, query)
     log.info(
-        f'Found {len(templates)} similar templates in: {timer.tocvalue()}'
+        f'Found {len(templates)} similar templates in: {timings["templates"]}'
     )
 
     if len(templates) == 0:
         log.info('Could not find any similar templates!')
-        return None
+        return 'no_templates'
 
     log.debug('Top 5 templates:')
     for x in templates[:min(len(templates) - 1, 5)]:
         log.debug(x)
 
-    answers = []
-
     # try various entity URIs and templates
-    # TODO: bad way of assigning URIs to specific entities... nested lists
-    iterations = 0
-    for template in templates:
-        for entities in uris:
-            if entities == None:
-                iterations += 1
-                continue
-            for entity_uri in entities:
-                if iterations >= config.MAX_TEMPLATE_SEARCHES:
-                    log.info(
-                        'Maximum iterations of templates exceeded, no results :(')
-                    return []
-
-                iterations += 1
-                query_string = replace_uris_in_query(
-                    template[2], entity_uri)
-                log.debug(query_string)
-                results = query(query_string)
-
-                try:
-                    bindings = parse_query_response(results)
-                    if len(bindings) == 0:
-                        continue
-
-                    return [get_result_value(x) for x in bindings]
-                except SPARQLQueryError as error:
-                    log.info('Could not find matching entity URI')
-                    log.debug(error)
-
-    return answers
+    with metrics.timed('queries', timings):
+        candidates = get_candidates(templates, uris, predicates)
+        found = find_answer(candidates)
+
+    if found == None:
+        if len(candidates) >= config.MAX_TEMPLATE_SEARCHES:
+            log.info('Maximum iterations of templates exceeded, no results :(')
+        details['answers'] = []
+        return 'unanswered'
+
+    rank, answers = found
+    details['match'] = describe_match(*candidates[rank])
+    details['answers'] = answers
+    return 'answered'
+
+
+def get_answer(
+    question: str,
+    templates: List,
+    vectors: Union[np.ndarray, None] = None,
+    index=None
+) -> Union[None, List[str]]:
+    return answer_question(question, templates, vectors, index)['answers']